@@ -0,0 +1,362 @@
+#!/usr/bin/env python3
+
+"""
+Benchmarks for the Donation report pipeline on synthetic gifts, no Raisers Edge access is needed.
+
+Usage:
+    python3 'Benchmark Report.py' load 1000 10000 100000 1000000
+    python3 'Benchmark Report.py' process 1000 100000 1000000
+    python3 'Benchmark Report.py' render 1000 10000 100000 1000000
+    python3 'Benchmark Report.py' weekly 1000 10000 100000 1000000
+    python3 'Benchmark Report.py' e2e 10000 100000 1000000
+    python3 'Benchmark Report.py' send 1 10 100
+    MEMORY_LIMIT_MB=512 python3 'Benchmark Report.py' memory 100000 1000000
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import tempfile
+import socket
+import subprocess
+import importlib.util
+
+SCRIPTS = os.path.dirname(os.path.abspath(__file__))
+
+PAGE_SIZE = 500
+
+# Vectorized process_data runs well under this, the old row-by-row .apply version was several times slower
+PROCESS_BUDGET_US = 3
+
+# Default row cap of the weekly gift list (REPORT_MAX_ROWS)
+MAX_ROWS = 500
+
+# Peak RSS the memory benchmark allows by default (MEMORY_LIMIT_MB), a low-memory full sync of 1M gifts stays well
+# under it where the in-memory one takes several GB
+MEMORY_LIMIT_MB = 512
+
+# Gifts of the send benchmark, whose sizes are numbers of reports
+SEND_GIFTS = 10000
+
+# Attachments of SEND_GIFTS gifts are small enough to go inline, so the send benchmark also sends files of these sizes,
+# in MB, to go through send_with_uploads: uploaded in a session from 3 MB, and attached to the draft below that
+SEND_UPLOADS = [[4, 0.1], [2.5]]
+
+# Share of messages in a $batch the Graph simulator throttles, low enough for each to get through in send_batch's
+# three attempts
+SEND_THROTTLE = 0.02
+
+# pretty_html_table slows down quadratically, about a minute for 10k rows, so it is left out of larger sizes
+LEGACY_RENDER_ROWS = 10000
+
+
+def load_script(name):
+    # Scripts have spaces in their names, so they can't be imported the usual way
+    spec = importlib.util.spec_from_file_location(name.lower().replace(' ', '_'), os.path.join(SCRIPTS, f'{name}.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    return module
+
+
+def synthetic_pages(size):
+    for offset in range(0, size, PAGE_SIZE):
+        yield {'value': [simulator.synthetic_gift(i) for i in range(offset, min(offset + PAGE_SIZE, size))]}
+
+
+def benchmark_load(report, sizes):
+    print('Staging pages and loading them back (pagination_api_request -> load_from_staging)')
+
+    run = report.ReportRun()
+
+    for size in sizes:
+        report.clear_staging(run)
+        os.makedirs('Database/Staging')
+
+        # Only the pipeline is timed, generating the synthetic pages is not
+        elapsed = 0
+        for page, response in enumerate(synthetic_pages(size), start=1):
+            start = time.perf_counter()
+            report.stage_page(run, response, page)
+            elapsed += time.perf_counter() - start
+
+        start = time.perf_counter()
+        data = report.load_from_staging(run)
+        elapsed += time.perf_counter() - start
+
+        assert len(data) == size
+
+        # Linear scaling shows up as a flat time per gift across sizes
+        print(f'{size:>10,} gifts {elapsed:10.2f} s {elapsed / size * 1e6:10.2f} µs/gift')
+
+
+def benchmark_process(report, sizes):
+    print('Deriving receipt date and campaign of gifts (process_data)')
+
+    run = report.ReportRun()
+
+    for size in sorted(sizes):
+        gifts = report.pa.concat_tables(
+            report.pa.Table.from_pylist(response['value'], schema=report.GIFT_WIRE_SCHEMA)
+            for response in synthetic_pages(size)
+        )
+        date_added = gifts['date_added']
+        gifts = gifts.cast(report.GIFT_SCHEMA).flatten()
+
+        start = time.perf_counter()
+        data = report.process_data(run, gifts, date_added)
+        elapsed = time.perf_counter() - start
+
+        assert data['receipt_date'].null_count == 0
+
+        print(f'{size:>10,} gifts {elapsed:10.4f} s {elapsed / size * 1e6:10.4f} µs/gift')
+
+    # Guard against process_data slipping back to row-by-row Python, measured on the largest size where fixed
+    # overheads no longer dominate
+    if elapsed / size * 1e6 > PROCESS_BUDGET_US:
+        sys.exit(f'process_data took {elapsed / size * 1e6:.2f} µs/gift, over the budget of {PROCESS_BUDGET_US} µs/gift')
+
+
+def synthetic_weekly(report, size):
+    # Weekly gift list as get_weekly_donation formats it
+    rng = random.Random(size)
+
+    return report.pd.DataFrame({
+        'Date of Credit': [f'{rng.randint(1, 28):02d}-Mar-2024' for _ in range(size)],
+        'Amount': [f'₹ {rng.randint(100, 500000):,}' for _ in range(size)],
+        'Name of Donor': [f'Donor & Family {rng.randint(1, size)}' for _ in range(size)],
+        'Purpose/ Project Description': [f'Project <{rng.randint(1, 200)}>' for _ in range(size)]
+    })
+
+
+def legacy_render(data):
+    # prepare_report as it was before the Jinja2 template
+    from pretty_html_table import build_table
+
+    return build_table(data, 'blue_dark', font_family='Open Sans, Helvetica, Arial, sans-serif', even_color='black',
+                       padding='10px', width='700px', font_size='16px').replace(
+        "background-color: #D9E1F2;font-family: Open Sans",
+        "background-color: #D9E1F2; color: black;font-family: Open Sans")
+
+
+def benchmark_render(report, sizes):
+    print('Rendering the weekly gift list as HTML (prepare_report), against pretty_html_table')
+
+    for size in sizes:
+        data = synthetic_weekly(report, size)
+        timings = []
+
+        for name, render in [
+            ('pretty_html_table', legacy_render),
+            ('template', report.prepare_report),
+            (f'capped at {MAX_ROWS}', lambda data: report.prepare_report(data, MAX_ROWS))
+        ]:
+            if render is legacy_render and size > LEGACY_RENDER_ROWS:
+                timings.append(f'{name}  skipped')
+                continue
+
+            start = time.perf_counter()
+            html = render(data)
+            timings.append(f'{name} {time.perf_counter() - start:8.3f} s {len(html) / 1e6:8.2f} MB')
+
+        print(f'{size:>10,} rows   ' + '   '.join(timings))
+
+
+def benchmark_weekly(report, sizes):
+    print('Joining donor and project names onto the gifts of the week (get_weekly_gifts), no calls to RE')
+
+    run = report.ReportRun()
+    today = report.pd.Timestamp('today').normalize()
+
+    for size in sizes:
+        # Every gift falls in the week, from donors and campaigns as many as in the simulator
+        gifts = [simulator.synthetic_gift(i) for i in range(size)]
+
+        run.calendar = report.FiscalCalendar(today)
+        run.re_donation = report.pd.DataFrame({
+            'receipt_date': [today - report.timedelta(days=6 - i * 7 // size) for i in range(size)],
+            'amount.value': [gift['amount']['value'] for gift in gifts],
+            'constituent_id': [gift['constituent_id'] for gift in gifts],
+            'campaign_id': [gift['gift_splits'][0]['campaign_id'] for gift in gifts]
+        })
+
+        run.constituents = report.to_constituents(
+            [simulator.synthetic_constituent(id) for id in run.re_donation['constituent_id'].unique()])
+        run.campaigns = report.pd.DataFrame({
+            'campaign_id': [str(id) for id in range(1, simulator.CAMPAIGNS + 1)],
+            'name': [f'Campaign {id}' for id in range(1, simulator.CAMPAIGNS + 1)]
+        })
+
+        start = time.perf_counter()
+        data = report.get_weekly_gifts(run)
+        elapsed = time.perf_counter() - start
+
+        assert len(data) == size and data['Name of Donor'].notna().all()
+
+        print(f'{size:>10,} gifts {elapsed * 1000:10.1f} ms')
+
+
+def start_simulator(script, *args):
+    # A port the OS hands out is free to reuse right after the probe socket closes
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+
+    server = subprocess.Popen([sys.executable, os.path.join(SCRIPTS, f'{script}.py'), '--port', str(port), *args],
+                              stderr=subprocess.DEVNULL)
+
+    for attempt in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            break
+        except OSError:
+            time.sleep(0.1)
+
+    return server, f'http://127.0.0.1:{port}'
+
+
+def run_e2e(report, size, send=False, reports=None, **settings):
+    """
+    Full sync and report of size simulated gifts in a fresh directory, the emails are only sent when send is True.
+    Returns the seconds it took and the run.
+    """
+    server, re_api_url = start_simulator('Simulate RE API', '--gifts', str(size))
+
+    directory = tempfile.mkdtemp()
+    os.makedirs(os.path.join(directory, 'Database'))
+    os.makedirs(os.path.join(directory, 'Logs'))
+
+    with open(os.path.join(directory, 'access_token_output.json'), 'w') as token_file:
+        json.dump({'access_token': 'benchmark', 'refresh_token': 'benchmark', 'expires_in': 3600}, token_file)
+
+    if reports is not None:
+        with open(os.path.join(directory, 'Reports.json'), 'w') as reports_file:
+            json.dump(reports, reports_file)
+
+    run = report.ReportRun(directory, env={
+        'RE_API_URL': re_api_url,
+        'RE_API_KEY': 'benchmark',
+        'RE_RATE_LIMIT': '1000',
+        'SEND_TO': '[]',
+        'CC_TO': '[]',
+        'LOG_LEVEL': 'quiet',
+        **settings
+    })
+
+    # Emails sent to the Graph simulator get their token from its stub rather than Microsoft login
+    if 'GRAPH_URL' in settings:
+        run.graph_app = graph_simulator.TokenStub()
+
+    try:
+        start = time.perf_counter()
+        report.run_reports(run, send=send)
+        elapsed = time.perf_counter() - start
+
+    finally:
+        report.stop_logging(run)
+        server.terminate()
+
+    return elapsed, run
+
+
+def benchmark_e2e(report, sizes):
+    print('Full sync and report against the RE API simulator (Simulate RE API.py), emails are not sent')
+
+    # Memory freed by a run isn't always handed back to the OS, so runs go from the smallest size to the largest
+    for size in sorted(sizes):
+        elapsed, run = run_e2e(report, size)
+        summary = run.stats.summary()
+
+        print(f'{size:>10,} gifts {elapsed:10.2f} s {size / elapsed:10,.0f} gifts/s '
+              f'{summary["peak_rss_mb"]:10,.1f} MB peak RSS {summary["http_requests"]:8,} requests')
+
+
+def benchmark_memory(report, sizes):
+    limit = int(os.getenv('MEMORY_LIMIT_MB', MEMORY_LIMIT_MB))
+
+    print(f'Low-memory full sync and report against the RE API simulator, peak RSS has to stay under {limit:,} MB')
+
+    for size in sorted(sizes):
+        # The stage that goes over MEMORY_LIMIT_MB fails the run
+        try:
+            elapsed, run = run_e2e(report, size, LOW_MEMORY='true', MEMORY_LIMIT_MB=str(limit))
+
+        except MemoryError as error:
+            sys.exit(f'{size:,} gifts: {error}')
+
+        print(f'{size:>10,} gifts {elapsed:10.2f} s {run.stats.summary()["peak_rss_mb"]:10,.1f} MB peak RSS')
+
+
+def benchmark_send(report, sizes):
+    print(f'Sending reports on {SEND_GIFTS:,} gifts through the Graph simulator (Simulate Graph API.py), every other '
+          f'one with attachments, and {len(SEND_UPLOADS)} with generated files too large to inline')
+
+    for size in sizes:
+        reports = [{
+            'name': f'Report {i}',
+            'sections': ['ytd', 'monthly'] if i % 2 else ['ytd'],
+            'send_to': [f'team-{i}@example.org'],
+            'cc_to': []
+        } for i in range(size)]
+
+        server, graph_url = start_simulator('Simulate Graph API', '--throttle', str(SEND_THROTTLE))
+
+        try:
+            elapsed, run = run_e2e(report, SEND_GIFTS, send=True, reports=reports, GRAPH_URL=graph_url,
+                                   FROM='reports@example.org')
+
+            uploads = []
+            for i, megabytes in enumerate(SEND_UPLOADS):
+                paths = []
+                for j, file_megabytes in enumerate(megabytes):
+                    paths.append(run.path(f'Database/Upload {i}-{j}.zip'))
+
+                    with open(paths[-1], 'wb') as file:
+                        file.write(os.urandom(int(file_megabytes * 1024 * 1024)))
+
+                uploads.append({'name': f'Upload {i}', 'subject': f'Upload {i}', 'send_to': [f'uploads-{i}@example.org'],
+                                'cc_to': [], 'sections': ['monthly'], 'paths': paths})
+
+            report.send_email(run, [report.get_email(run, upload, {}, upload['paths']) for upload in uploads])
+
+            sent = report.requests.get(f'{graph_url}/sent').json()['value']
+
+        finally:
+            server.terminate()
+
+        stage = run.stats.summary()['stages']['send_email']
+
+        print(f'{size:>10,} reports {stage["seconds"]:10.2f} s {stage["http_requests"]:8,} requests '
+              f'{stage["rows_out"]:8,} sent')
+
+        # Every report reaches its own recipient once, with the attachments it should have
+        if sorted((message['to'][0], bool(message['attachments'])) for message in sent) != \
+                sorted((report['send_to'][0], 'monthly' in report['sections']) for report in reports + uploads):
+            sys.exit(f'Graph simulator got {len(sent)} messages for {size + len(uploads)}, not one each as expected')
+
+
+BENCHMARKS = {
+    'load': benchmark_load,
+    'process': benchmark_process,
+    'render': benchmark_render,
+    'weekly': benchmark_weekly,
+    'e2e': benchmark_e2e,
+    'memory': benchmark_memory,
+    'send': benchmark_send
+}
+
+if __name__ == '__main__':
+    name = sys.argv[1] if len(sys.argv) > 1 else 'load'
+    sizes = [int(size) for size in sys.argv[2:]] or [1000, 10000, 100000, 1000000]
+
+    report = load_script('Get Donation data')
+    simulator = load_script('Simulate RE API')
+    graph_simulator = load_script('Simulate Graph API')
+
+    # Work in a scratch directory so the real Database/ is never touched
+    os.chdir(tempfile.mkdtemp())
+    os.makedirs('Database')
+
+    BENCHMARKS[name](report, sizes)
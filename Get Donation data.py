@@ -1,112 +1,697 @@
-import numpy as np
 import requests
 import os
 import json
 import glob
+import shutil
 import locale
 import msal
 import base64
 import logging
+import time
+import fcntl
+import threading
+import collections
+import resource
+import cProfile
+import contextlib
+import zipfile
+import hashlib
+import jinja2
+import markupsafe
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pv
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
 
 from datetime import datetime
 from datetime import timedelta
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor
 from requests.adapters import HTTPAdapter
 from urllib3 import Retry
-from pretty_html_table import build_table
-from dotenv import load_dotenv
+from dotenv import dotenv_values
+
+# Gift record as returned by /gift/v1/gifts, with the types it is stored in
+AMOUNT = pa.struct([('value', pa.float64())])
+
+GIFT_SCHEMA = pa.schema([
+    ('id', pa.string()),
+    ('amount', AMOUNT),
+    ('balance', AMOUNT),
+    ('batch_number', pa.string()),
+    ('constituency', pa.string()),
+    ('constituent_id', pa.string()),
+    ('date', pa.timestamp('ns')),
+    ('date_added', pa.timestamp('ns', tz='UTC')),
+    ('date_modified', pa.timestamp('ns', tz='UTC')),
+    ('gift_status', pa.dictionary(pa.int8(), pa.string())),
+    ('is_anonymous', pa.bool_()),
+    ('lookup_id', pa.string()),
+    ('post_date', pa.timestamp('ns')),
+    ('post_status', pa.dictionary(pa.int8(), pa.string())),
+    ('receipt_amount', AMOUNT),
+    ('reference', pa.string()),
+    ('subtype', pa.dictionary(pa.int8(), pa.string())),
+    ('type', pa.dictionary(pa.int8(), pa.string())),
+    ('receipts', pa.list_(pa.struct([
+        ('amount', AMOUNT),
+        ('date', pa.timestamp('ns')),
+        ('number', pa.int64()),
+        ('status', pa.string())
+    ]))),
+    ('gift_splits', pa.list_(pa.struct([
+        ('id', pa.string()),
+        ('amount', AMOUNT),
+        ('appeal_id', pa.string()),
+        ('campaign_id', pa.string()),
+        ('fund_id', pa.string()),
+        ('package_id', pa.string())
+    ])))
+])
+
+# Columns of the Database/Gifts dataset, amounts flattened the same way as pd.json_normalize would ('amount.value'),
+# plus the fields derived by process_data
+GIFT_STORE_SCHEMA = GIFT_SCHEMA.empty_table().flatten().schema.append(
+    pa.field('receipt_date', pa.timestamp('ns'))).append(
+    pa.field('campaign_id', pa.string()))
+
+
+def to_wire_type(data_type):
+    """
+    Type of a GIFT_SCHEMA field as it arrives in JSON: dates and categories are plain strings
+    """
+    if pa.types.is_timestamp(data_type) or pa.types.is_dictionary(data_type):
+        return pa.string()
+    elif pa.types.is_struct(data_type):
+        return pa.struct([field.with_type(to_wire_type(field.type)) for field in data_type])
+    elif pa.types.is_list(data_type):
+        return pa.list_(to_wire_type(data_type.value_type))
+    else:
+        return data_type
 
-def set_current_directory():
-    os.chdir(os.getcwd())
 
+GIFT_WIRE_SCHEMA = pa.schema([field.with_type(to_wire_type(field.type)) for field in GIFT_SCHEMA])
 
-def start_logging():
-    global process_name
+# Database/Gifts is partitioned by the financial year of the receipt date, e.g. receipt_financial_year=2023/
+GIFT_PARTITIONING = ds.partitioning(pa.schema([('receipt_financial_year', pa.int32())]), flavor='hive')
 
-    # Get File Name of existing script
-    process_name = os.path.basename(__file__).replace('.py', '').replace(' ', '_')
+# Columns of Database/Gifts read as a dataset, given when it is opened so a store with no partitions still has them
+GIFT_DATASET_SCHEMA = GIFT_STORE_SCHEMA.append(pa.field('receipt_financial_year', pa.int32()))
 
-    logging.basicConfig(filename=f'Logs/{process_name}.log', format='%(asctime)s %(message)s', filemode='w',
-                        level=logging.DEBUG)
+LOG_LEVELS = {
+    'debug': logging.DEBUG,
+    'info': logging.INFO,
+    'quiet': logging.WARNING
+}
 
-    # Printing the output to file for debugging
-    logging.info('Starting the Script')
 
+class RunLogger:
+    """
+    Log of one run in its own file, each line an event followed by its fields as key=value. Hot-path events, one per
+    API call or page, are only counted and every `sample`th written at debug level, their totals are written on close.
+    """
 
-def stop_logging():
-    logging.info('Stopping the Script')
+    def __init__(self, name, sample=100):
+        self.logger = logging.getLogger(f'donation.{name}')
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
 
+        self.sample = sample
+        self.counts = collections.Counter()
+        self.handler = None
+        self.lock = threading.Lock()
 
-def housekeeping():
-    logging.info('Doing Housekeeping')
+    def open(self, path):
+        self.handler = logging.FileHandler(path, mode='w')
+        self.handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+        self.logger.addHandler(self.handler)
 
-    # Housekeeping
-    multiple_files = glob.glob('*_RE_*.json')
+    def set_level(self, level):
+        self.logger.setLevel(LOG_LEVELS[level])
+
+    def write_counts(self):
+        if self.counts:
+            self.info('Hot path totals', **self.counts)
+            self.counts.clear()
+
+    def close(self):
+        self.write_counts()
+
+        if self.handler is not None:
+            self.logger.removeHandler(self.handler)
+            self.handler.close()
+
+    def write(self, level, event, fields):
+        if self.logger.isEnabledFor(level):
+            self.logger.log(level, ' '.join([event] + [
+                f'{key}={json.dumps(value, default=str)}' for key, value in fields.items()
+            ]))
+
+    def debug(self, event, **fields):
+        self.write(logging.DEBUG, event, fields)
+
+    def info(self, event, **fields):
+        self.write(logging.INFO, event, fields)
+
+    def warning(self, event, **fields):
+        self.write(logging.WARNING, event, fields)
+
+    def error(self, event, **fields):
+        self.write(logging.ERROR, event, fields)
+
+    def hot(self, event, **fields):
+        with self.lock:
+            self.counts[event] += 1
+            count = self.counts[event]
+
+        if count % self.sample == 1 or self.sample == 1:
+            self.write(logging.DEBUG, event, {'count': count, **fields})
+
+
+class ReportRun:
+    """
+    One run of the report: its settings, HTTP session, RE token, log and stats, and the data shared by its reports.
+    Everything a run reads or writes is under its own directory (Database/, Logs/, Reports.json and the RE token), so
+    runs for different tenants or report variants can go side by side in one process.
+    """
+
+    def __init__(self, directory='.', env=None):
+        self.directory = directory
+
+        # Settings come from env when given, otherwise from the .env file, see get_env_variables()
+        self.env = env
+
+        # Get File Name of existing script
+        self.process_name = os.path.basename(__file__).replace('.py', '').replace(' ', '_')
+
+        self.log = RunLogger(os.path.abspath(directory))
+        self.stats = RunStats()
+        self.profiler = None
+        self.mailer = None
+
+        # msal app the mailer gets its Graph token from, one is made from the settings when left as None. The TokenStub
+        # of 'Simulate Graph API.py' goes here to send to the simulator without Microsoft login.
+        self.graph_app = None
+
+        # Set up by set_api_request_strategy() and set_token_provider()
+        self.http = None
+        self.rate_limiter = None
+        self.token_provider = None
+
+        # Set by get_timeline()
+        self.calendar = None
+
+        # Shared by every report of the run, and kept warm between syncs by 'Report Service.py'
+        self.daily_donation = None
+        self.re_donation = None
+        self.constituents = None
+        self.campaigns = None
+        self.fy_daily_donation = None
+        self.weekly_snapshots = None
+        self.weekly_gifts = None
+        self.rendered_sections = {}
+
+    def path(self, *parts):
+        return os.path.join(self.directory, *parts)
+
+
+def set_current_directory():
+    os.chdir(os.getcwd())
+
+
+def start_logging(run):
+    run.log.open(run.path(f'Logs/{run.process_name}.log'))
+
+    # Printing the output to file for debugging
+    run.log.info('Starting the Script')
+
+
+def stop_logging(run):
+    run.log.info('Stopping the Script')
+    run.log.close()
 
-    # Iterate over the list of filepaths & remove each file.
-    logging.info('Removing old JSON files')
-    for each_file in multiple_files:
+
+def housekeeping(run):
+    run.log.info('Doing Housekeeping')
+
+    # Housekeeping, staged API pages are kept so that an interrupted pull can resume from them
+    run.log.info('Removing temporary files')
+    for each_file in glob.glob(run.path('Database/**/*.tmp'), recursive=True):
         try:
             os.remove(each_file)
         except:
             pass
 
-def set_api_request_strategy():
-    logging.info('Setting API Request strategy')
+    # Attachments are written fresh for every run
+    shutil.rmtree(run.path('Database/Attachments'), ignore_errors=True)
+
+def clear_staging(run):
+    run.log.info('Removing staged API pages')
+
+    shutil.rmtree(run.path('Database/Staging'), ignore_errors=True)
+
+class RateLimiter:
+    """
+    Token bucket shared by every thread calling the SKY API, refilled at `rate` requests per second
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+
+        # Holds at least one request, or a rate under one per second would never fill it enough to send any
+        self.capacity = max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+
+                if now >= self.paused_until:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+
+                    wait = (1 - self.tokens) / self.rate
+
+                else:
+                    wait = self.paused_until - now
+
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        # Quota is per subscription, so a Retry-After holds back every thread, not only the one that got the 429
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.updated = self.paused_until
+            self.tokens = 0
+
+class RunStats:
+    """
+    Wall time, peak RSS, rows in and out and HTTP traffic of each stage of a run, summed over every call of the stage.
+    HTTP counters of a stage are everything the process sent while it ran, threads included. Peak RSS of a stage is the
+    highest current RSS sampled while it ran, so a stage after a heavier one still shows its own. A stage that peaks
+    over memory_limit_mb raises MemoryError once it is done, failing the run.
+    """
+
+    HTTP_COUNTERS = ['http_requests', 'http_retries', 'http_bytes']
+
+    # Seconds between samples of current RSS while any stage is running
+    RSS_SAMPLE_SECONDS = 0.05
 
-    global http
+    def __init__(self, memory_limit_mb=0):
+        self.started = datetime.now()
+        self.stages = {}
+        self.http = dict.fromkeys(self.HTTP_COUNTERS, 0)
+        self.error = None
+        self.memory_limit_mb = memory_limit_mb
+        self.lock = threading.Lock()
 
-    # API Request strategy
-    logging.info('Setting API Request Strategy')
+        # Counts of the stages running now, and the thread sampling RSS into them, which stops when there are none
+        self.running = []
+        self.sampler = None
+        self.peak_rss_mb = 0
 
+    @contextlib.contextmanager
+    def stage(self, name, rows_in=0):
+        counts = {'rows_in': rows_in, 'rows_out': 0, 'peak_rss_mb': 0}
+        http = dict(self.http)
+        start = time.perf_counter()
+
+        with self.lock:
+            self.running.append(counts)
+
+            if self.sampler is None:
+                self.sampler = threading.Thread(target=self.sample_rss_while_running, daemon=True)
+                self.sampler.start()
+
+        self.sample_rss()
+
+        try:
+            yield counts
+
+        finally:
+            self.sample_rss()
+
+            with self.lock:
+                self.running = [running for running in self.running if running is not counts]
+
+                stage = self.stages.setdefault(name, {
+                    'calls': 0, 'seconds': 0.0, 'rows_in': 0, 'rows_out': 0, 'peak_rss_mb': 0,
+                    **dict.fromkeys(self.HTTP_COUNTERS, 0)
+                })
+
+                stage['calls'] += 1
+                stage['seconds'] += time.perf_counter() - start
+                stage['rows_in'] += counts['rows_in']
+                stage['rows_out'] += counts['rows_out']
+                stage['peak_rss_mb'] = max(stage['peak_rss_mb'], counts['peak_rss_mb'])
+
+                for counter in self.HTTP_COUNTERS:
+                    stage[counter] += self.http[counter] - http[counter]
+
+        if self.memory_limit_mb and counts['peak_rss_mb'] > self.memory_limit_mb:
+            raise MemoryError(f'Stage {name} peaked at {counts["peak_rss_mb"]:,} MB, over MEMORY_LIMIT_MB of '
+                              f'{self.memory_limit_mb:,} MB')
+
+    def sample_rss(self):
+        rss = get_current_rss()
+
+        with self.lock:
+            for counts in self.running:
+                counts['peak_rss_mb'] = max(counts['peak_rss_mb'], rss)
+
+            self.peak_rss_mb = max(self.peak_rss_mb, rss)
+
+    def sample_rss_while_running(self):
+        while True:
+            time.sleep(self.RSS_SAMPLE_SECONDS)
+
+            with self.lock:
+                if not self.running:
+                    self.sampler = None
+                    return
+
+            self.sample_rss()
+
+    def record_http(self, response, retry=False):
+        # Retries made by the urllib3 Retry strategy never surface as responses, they are only in its history
+        retries = response.raw.retries
+        retried = len(retries.history) if retries else 0
+
+        with self.lock:
+            self.http['http_requests'] += 1 + retried
+            self.http['http_retries'] += retried + retry
+            self.http['http_bytes'] += len(response.request.body or b'') + len(response.content)
+
+    def summary(self):
+        return {
+            'started': self.started.isoformat(),
+            'seconds': round((datetime.now() - self.started).total_seconds(), 3),
+            'peak_rss_mb': self.peak_rss_mb,
+            'process_peak_rss_mb': get_peak_rss(),
+            'memory_limit_mb': self.memory_limit_mb,
+            'over_memory_limit': self.is_over_memory_limit(),
+            'error': self.error,
+            **self.http,
+            'stages': {
+                name: {**stage, 'seconds': round(stage['seconds'], 3)} for name, stage in self.stages.items()
+            }
+        }
+
+    def is_over_memory_limit(self):
+        return bool(self.memory_limit_mb) and self.peak_rss_mb > self.memory_limit_mb
+
+def get_peak_rss():
+    # ru_maxrss is in kilobytes on Linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+def get_current_rss():
+    # Resident pages of the process right now, where ru_maxrss only ever goes up. Falls back to that outside Linux.
+    try:
+        with open('/proc/self/statm') as statm:
+            return round(int(statm.read().split()[1]) * resource.getpagesize() / 1024 / 1024, 1)
+
+    except OSError:
+        return get_peak_rss()
+
+def start_profiling(run):
+    if run.profile:
+        run.log.info('Starting cProfile')
+
+        run.profiler = cProfile.Profile()
+        run.profiler.enable()
+
+def write_run_summary(run):
+    run.log.info('Writing run summary')
+
+    if run.profiler is not None:
+        run.profiler.disable()
+        run.profiler.dump_stats(run.path(f'Logs/{run.process_name}.prof'))
+
+    if run.stats.is_over_memory_limit():
+        run.log.warning('Peak memory over MEMORY_LIMIT_MB', peak_rss_mb=run.stats.peak_rss_mb,
+                        memory_limit_mb=run.stats.memory_limit_mb)
+
+    with open(run.path(f'Logs/{run.process_name}_summary.json'), 'w') as summary_file:
+        json.dump(run.stats.summary(), summary_file, indent=4)
+
+def set_api_request_strategy(run):
+    run.log.info('Setting API Request strategy')
+
+    # 429s are left to the rate limiter in get_request_re, which honours Retry-After across all threads
     retry_strategy = Retry(
         total=3,
-        status_forcelist=[429, 500, 502, 503, 504],
+        status_forcelist=[500, 502, 503, 504],
         allowed_methods=['HEAD', 'GET', 'OPTIONS'],
         backoff_factor=10
     )
 
-    adapter = HTTPAdapter(max_retries=retry_strategy)
-    http = requests.Session()
-    http.mount('https://', adapter)
-    http.mount('http://', adapter)
+    run.rate_limiter = RateLimiter(run.re_rate_limit)
+
+    adapter = HTTPAdapter(max_retries=retry_strategy, pool_connections=run.re_concurrency, pool_maxsize=run.re_concurrency)
+    run.http = requests.Session()
+    run.http.mount('https://', adapter)
+    run.http.mount('http://', adapter)
+
+
+def get_env_variables(run):
+    run.log.info('Setting Environment variables')
+
+    # Variables set in the environment take precedence over the .env file in the run's directory, as with load_dotenv
+    if run.env is None:
+        run.env = {**dotenv_values(run.path('.env')), **os.environ}
+
+    env = run.env
+
+    run.auth_code = env.get('AUTH_CODE')
+    run.re_api_key = env.get('RE_API_KEY')
+    run.client_id = env.get('CLIENT_ID')
+    run.o_client_id = env.get('O_CLIENT_ID')
+    run.client_secret = env.get('CLIENT_SECRET')
+    run.tenant_id = env.get('TENANT_ID')
+    run.from_address = env.get('FROM')
+    run.send_to = eval(env.get('SEND_TO'))
+    run.cc_to = eval(env.get('CC_TO'))
+    run.error_emails_to = env.get('ERROR_EMAILS_TO')
+    run.full_sync_days = int(env.get('FULL_SYNC_DAYS', 7))
+    run.re_concurrency = int(env.get('RE_CONCURRENCY', 4))
+    run.re_rate_limit = float(env.get('RE_RATE_LIMIT', 10))
+    run.report_only = env.get('REPORT_ONLY', 'false').lower() == 'true'
+    run.receipt_lookback_days = int(env.get('RECEIPT_LOOKBACK_DAYS', 365))
+    run.report_max_rows = int(env.get('REPORT_MAX_ROWS', 500))
+    run.profile = env.get('PROFILE', 'false').lower() == 'true'
+    run.re_api_url = env.get('RE_API_URL', 'https://api.sky.blackbaud.com').rstrip('/')
+    run.graph_url = env.get('GRAPH_URL', 'https://graph.microsoft.com/v1.0')
+    run.low_memory = env.get('LOW_MEMORY', 'false').lower() == 'true'
+    run.stats.memory_limit_mb = int(env.get('MEMORY_LIMIT_MB', 0))
+
+    run.log.set_level(env.get('LOG_LEVEL', 'info').lower())
+
+class GraphMailer:
+    """
+    Sends mail as FROM through Microsoft Graph. One app token is reused until shortly before it expires, requests go
+    over one pooled session with retries, and many messages can be submitted together through JSON $batch.
+    """
+
+    # Messages over Graph's 4 MB request limit fail, so larger attachments are uploaded separately, and a $batch holds
+    # at most 20 messages and about as many bytes
+    INLINE_ATTACHMENT_BYTES = 2 * 1024 * 1024
+    BATCH_BYTES = 4 * 1024 * 1024
+
+    # Upload sessions only take files of 3 MB and more, smaller ones are attached to the draft in one request.
+    # Their chunks have to be a multiple of 320 KiB.
+    UPLOAD_SESSION_BYTES = 3 * 1024 * 1024
+    UPLOAD_CHUNK_BYTES = 10 * 320 * 1024
+
+    def __init__(self, run, graph_url='https://graph.microsoft.com/v1.0', app=None):
+        self.run = run
+        self.graph_url = graph_url
+        self.app = app or msal.ConfidentialClientApplication(
+            client_id=self.run.o_client_id,
+            client_credential=self.run.client_secret,
+            authority=f'https://login.microsoftonline.com/{self.run.tenant_id}'
+        )
 
+        self.result = None
+        self.expires_at = 0
 
-def get_env_variables():
-    logging.info('Setting Environment variables')
+        # Only statuses where Graph did not accept the message are retried, so nothing is sent twice
+        retry_strategy = Retry(
+            total=3,
+            status_forcelist=[429, 503, 504],
+            allowed_methods=['POST'],
+            backoff_factor=2
+        )
 
-    global RE_API_KEY, CLIENT_ID, O_CLIENT_ID, CLIENT_SECRET, TENANT_ID, FROM, CC_TO, SEND_TO, ERROR_EMAILS_TO
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(max_retries=retry_strategy))
+        self.session.mount('http://', HTTPAdapter(max_retries=retry_strategy))
 
-    load_dotenv()
+    def acquire_token(self):
+        if self.result is None or 'access_token' not in self.result or time.time() >= self.expires_at:
+            self.result = self.app.acquire_token_for_client(scopes=['https://graph.microsoft.com/.default'])
+            self.expires_at = time.time() + int(self.result.get('expires_in', 0)) - 300
 
-    RE_API_KEY = os.getenv('RE_API_KEY')
-    CLIENT_ID = os.getenv('CLIENT_ID')
-    O_CLIENT_ID = os.getenv('O_CLIENT_ID')
-    CLIENT_SECRET = os.getenv('CLIENT_SECRET')
-    TENANT_ID = os.getenv('TENANT_ID')
-    FROM = os.getenv('FROM')
-    SEND_TO = eval(os.getenv('SEND_TO'))
-    CC_TO = eval(os.getenv('CC_TO'))
-    ERROR_EMAILS_TO = os.getenv('ERROR_EMAILS_TO')
+        return self.result
 
-def send_error_emails(subject, arg):
-    logging.info('Sending email for an error')
+    def post(self, path, body):
+        response = self.session.post(
+            self.graph_url + path,
+            headers={
+                'Authorization': 'Bearer ' + self.acquire_token()['access_token']
+            },
+            json=body,
+            timeout=60
+        )
+        self.run.stats.record_http(response)
 
-    authority = f'https://login.microsoftonline.com/{TENANT_ID}'
+        return response
 
-    app = msal.ConfidentialClientApplication(
-        client_id=O_CLIENT_ID,
-        client_credential=CLIENT_SECRET,
-        authority=authority
-    )
+    def send(self, email_msg):
+        return self.post(f'/users/{self.run.from_address}/sendMail', email_msg)
+
+    def send_with_uploads(self, email_msg, paths):
+        """
+        Send a message with attachments too large to inline. It is saved as a draft, each file of 3 MB or more is
+        uploaded to it in chunks through an upload session and smaller ones are attached as they are, then the draft is
+        sent. Returns the HTTP status of the send.
+        """
+        response = self.post(f'/users/{self.run.from_address}/messages', email_msg['Message'])
+
+        if not response.ok:
+            return response.status_code
+
+        message_id = quote(response.json()['id'])
+
+        for path in paths:
+            if os.path.getsize(path) >= self.UPLOAD_SESSION_BYTES:
+                self.upload_attachment(message_id, path)
+            else:
+                self.add_attachment(message_id, path)
+
+        return self.post(f'/users/{self.run.from_address}/messages/{message_id}/send', None).status_code
+
+    def add_attachment(self, message_id, path):
+        self.run.log.info('Attaching attachment', name=os.path.basename(path))
+
+        response = self.post(f'/users/{self.run.from_address}/messages/{message_id}/attachments', get_attachment(path))
+        response.raise_for_status()
+
+    def upload_attachment(self, message_id, path):
+        self.run.log.info('Uploading attachment', name=os.path.basename(path))
+
+        size = os.path.getsize(path)
+
+        response = self.post(f'/users/{self.run.from_address}/messages/{message_id}/attachments/createUploadSession', {
+            'AttachmentItem': {
+                'attachmentType': 'file',
+                'name': os.path.basename(path),
+                'size': size
+            }
+        })
+        response.raise_for_status()
+
+        upload_url = response.json()['uploadUrl']
+
+        # The file is read one chunk at a time, the upload URL is pre-authenticated so no token is sent with it
+        with open(path, 'rb') as file:
+            for offset in range(0, size, self.UPLOAD_CHUNK_BYTES):
+                chunk = file.read(self.UPLOAD_CHUNK_BYTES)
+
+                response = self.session.put(upload_url, data=chunk, headers={
+                    'Content-Type': 'application/octet-stream',
+                    'Content-Range': f'bytes {offset}-{offset + len(chunk) - 1}/{size}'
+                }, timeout=60)
+                self.run.stats.record_http(response)
+                response.raise_for_status()
+
+    def batches(self, email_msgs, indexes):
+        batch = []
+        batch_bytes = 0
+
+        for i in indexes:
+            message_bytes = len(json.dumps(email_msgs[i]))
+
+            if batch and (len(batch) == 20 or batch_bytes + message_bytes > self.BATCH_BYTES):
+                yield batch
+                batch = []
+                batch_bytes = 0
+
+            batch.append(i)
+            batch_bytes += message_bytes
+
+        if batch:
+            yield batch
+
+    def send_batch(self, email_msgs):
+        """
+        Send many messages, up to 20 per $batch request (the Graph maximum) and fewer when they are large. Returns the
+        HTTP status of each message in order, messages throttled inside a batch are sent again after their Retry-After.
+        """
+        statuses = {}
+        pending = list(range(len(email_msgs)))
+
+        for attempt in range(3):
+            throttled = []
+            retry_after = 0
+
+            for batch in self.batches(email_msgs, pending):
+                response = self.post('/$batch', {
+                    'requests': [
+                        {
+                            'id': str(i),
+                            'method': 'POST',
+                            'url': f'/users/{self.run.from_address}/sendMail',
+                            'headers': {
+                                'Content-Type': 'application/json'
+                            },
+                            'body': email_msgs[i]
+                        } for i in batch
+                    ]
+                })
+
+                if not response.ok:
+                    for i in batch:
+                        statuses[i] = response.status_code
+                    continue
+
+                for item in response.json()['responses']:
+                    statuses[int(item['id'])] = item['status']
+
+                    if item['status'] == 429:
+                        throttled.append(int(item['id']))
+                        retry_after = max(retry_after, int(item.get('headers', {}).get('Retry-After', 5)))
+
+            if not throttled:
+                break
 
-    scopes = ["https://graph.microsoft.com/.default"]
+            time.sleep(retry_after)
+            pending = sorted(throttled)
 
-    result = None
-    result = app.acquire_token_silent(scopes, account=None)
+        return [statuses[i] for i in range(len(email_msgs))]
 
-    if not result:
-        result = app.acquire_token_for_client(scopes=scopes)
+def get_mailer(run):
+    # Created on first use, error emails may need it before the rest of the run is set up
+    if run.mailer is None:
+        run.mailer = GraphMailer(run, getattr(run, 'graph_url', 'https://graph.microsoft.com/v1.0'), run.graph_app)
+
+    return run.mailer
+
+def send_error_emails(run, subject, arg):
+    run.log.info('Sending email for an error')
+
+    result = get_mailer(run).acquire_token()
+
+    if result:
 
         TEMPLATE = """
            <table style="background-color: #ffffff; border-color: #ffffff; width: auto; margin-left: auto; margin-right: auto;">
@@ -166,15 +751,13 @@ def send_error_emails(subject, arg):
             error_log_message=arg
         )
 
-        # Set up attachment data
-        with open('Process.log', 'rb') as f:
+        # Set up attachment data, the log of this run
+        with open(run.path(f'Logs/{run.process_name}.log'), 'rb') as f:
             attachment_content = f.read()
         attachment_content = base64.b64encode(attachment_content).decode('utf-8')
 
         if "access_token" in result:
 
-            endpoint = f'https://graph.microsoft.com/v1.0/users/{FROM}/sendMail'
-
             email_msg = {
                 'Message': {
                     'Subject': subject,
@@ -185,14 +768,14 @@ def send_error_emails(subject, arg):
                     'ToRecipients': [
                         {
                             'EmailAddress': {
-                                'Address': ERROR_EMAILS_TO
+                                'Address': run.error_emails_to
                             }
                         }
                     ],
                     'Attachments': [
                         {
                             '@odata.type': '#microsoft.graph.fileAttachment',
-                            'name': 'Process.log',
+                            'name': f'{run.process_name}.log',
                             'contentBytes': attachment_content
                         }
                     ]
@@ -200,262 +783,952 @@ def send_error_emails(subject, arg):
                 'SaveToSentItems': 'true'
             }
 
-            requests.post(
-                endpoint,
-                headers={
-                    'Authorization': 'Bearer ' + result['access_token']
-                },
-                json=email_msg
-            )
+            get_mailer(run).send(email_msg)
+
+        else:
+            run.log.error('Unable to get a Graph token', error=result.get('error'),
+                          error_description=result.get('error_description'),
+                          correlation_id=result.get('correlation_id'))
+
+def print_json(d):
+    print(json.dumps(d, indent=4))
+
+
+class TokenProvider:
+    """
+    Keeps the RE access token in memory and refreshes it in-process shortly before it expires, or when RE rejects it.
+    access_token_output.json is only touched under a lock shared with 'Refresh Access Token.py', and replaced atomically.
+    """
+
+    def __init__(self, run, path=None, margin=300):
+        self.run = run
+        self.path = path or run.path('access_token_output.json')
+        self.margin = margin
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        with open(self.path) as access_token_output:
+            data = json.load(access_token_output)
+
+        # The token file has no issue time of its own, it is written right after the token is issued
+        self.access_token = data['access_token']
+        self.refresh_token = data['refresh_token']
+        self.expires_at = os.path.getmtime(self.path) + int(data.get('expires_in', 3600))
+
+    def get(self):
+        with self.lock:
+            if time.time() >= self.expires_at - self.margin:
+                self.refresh_locked()
+
+            return self.access_token
+
+    def refresh(self, rejected_token):
+        # Threads that got a 401 for the same token trigger a single refresh between them
+        with self.lock:
+            if self.access_token == rejected_token:
+                self.refresh_locked(rejected_token)
+
+            return self.access_token
+
+    def refresh_locked(self, rejected_token=None):
+        self.run.log.info('Refreshing RE access token')
+
+        with open(self.path + '.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+            # The cron job may have refreshed it already while we waited for the lock
+            self.load()
+
+            if rejected_token is None and time.time() < self.expires_at - self.margin:
+                return
+
+            if rejected_token is not None and self.access_token != rejected_token:
+                return
+
+            response = self.run.http.post(
+                'https://oauth2.sky.blackbaud.com/token',
+                data={
+                    'grant_type': 'refresh_token',
+                    'refresh_token': self.refresh_token
+                },
+                headers={
+                    'Content-Type': 'application/x-www-form-urlencoded',
+                    'Authorization': 'Basic ' + self.run.auth_code
+                }
+            )
+            self.run.stats.record_http(response)
+
+            response = response.json()
+
+            # Keep the existing token file if the refresh didn't return a token
+            if not response.get('access_token'):
+                self.run.log.error('Unable to refresh RE access token', response=response)
+                return
+
+            with open(self.path + '.tmp', 'w') as response_output:
+                json.dump(response, response_output, ensure_ascii=False, sort_keys=True, indent=4)
+
+            os.replace(self.path + '.tmp', self.path)
+
+            self.load()
+
+def set_token_provider(run):
+    run.log.info('Loading RE access token')
+
+    run.token_provider = TokenProvider(run)
+
+def retrieve_token(run):
+    return run.token_provider.get()
+
+def get_request_re(run, url, params):
+    # One per API call, so only sampled
+    run.log.hot('RE GET', url=url)
+
+    # Retrieve access_token from memory
+    access_token = retrieve_token(run)
+
+    # Request headers
+    headers = {
+        'Bb-Api-Subscription-Key': run.re_api_key,
+        'Authorization': 'Bearer ' + access_token,
+    }
+
+    for attempt in range(5):
+        run.rate_limiter.acquire()
+
+        response = run.http.get(url, params=params, headers=headers)
+        run.stats.record_http(response, retry=attempt > 0)
+
+        # Token expired or was revoked mid-run
+        if response.status_code == 401:
+            access_token = run.token_provider.refresh(access_token)
+            headers['Authorization'] = 'Bearer ' + access_token
+            continue
+
+        if response.status_code != 429:
+            break
+
+        run.log.hot('RE rate limited', retry_after=response.headers.get('Retry-After', 1))
+        run.rate_limiter.pause(float(response.headers.get('Retry-After', 1)))
+
+    else:
+        # Still throttled or refused after every attempt, raised here rather than handing the error body to the caller
+        run.log.error('RE request failed after retries', url=url, status=response.status_code)
+        response.raise_for_status()
+
+    return response.json()
+
+def get_requests_re(run, urls, params=None):
+    """
+    GET many URLs concurrently (at most RE_CONCURRENCY at a time), responses come back in the order of urls
+    """
+    run.log.info('Running GET Requests from RE function concurrently', requests=len(urls))
+
+    with ThreadPoolExecutor(max_workers=run.re_concurrency) as executor:
+        return list(executor.map(lambda url: get_request_re(run, url, params or {}), urls))
+
+def post_request_re(run, url, params):
+    run.log.info('Running POST Request to RE function')
+
+    # Retrieve access_token from memory
+    access_token = retrieve_token(run)
+
+    # Request headers
+    headers = {
+        'Bb-Api-Subscription-Key': run.re_api_key,
+        'Authorization': 'Bearer ' + access_token,
+        'Content-Type': 'application/json',
+    }
+
+    re_api_response = run.http.post(url, params=params, headers=headers, json=params).json()
+
+    return re_api_response
+
+def patch_request_re(run, url, params):
+    run.log.info('Running PATCH Request to RE function')
+
+    # Retrieve access_token from memory
+    access_token = retrieve_token(run)
+
+    # Request headers
+    headers = {
+        'Bb-Api-Subscription-Key': run.re_api_key,
+        'Authorization': 'Bearer ' + access_token,
+        'Content-Type': 'application/json'
+    }
+
+    re_api_response = run.http.patch(url, headers=headers, data=json.dumps(params))
+
+    return re_api_response
+
+
+def load_from_staging(run):
+    run.log.info('Loading staged API pages from Parquet')
+
+    # Get a list of all the pages staged by pagination_api_request
+    fileList = sorted(glob.glob(run.path('Database/Staging/part-*.parquet')))
+
+    with run.stats.stage('load_from_staging') as stage:
+        df = ds.dataset(fileList, schema=GIFT_STORE_SCHEMA, format='parquet').to_table().to_pandas()
+        stage['rows_in'] = len(df)
+
+        # A resumed pull may have staged a gift twice if records shifted between pages in the meantime
+        df = df.drop_duplicates(subset='id', keep='last').reset_index(drop=True)
+        stage['rows_out'] = len(df)
+
+    return df
+
+def read_staged_gifts(run, columns=None):
+    """
+    Staged gifts one page at a time, without the duplicates a resumed pull may have staged (the last copy is kept)
+    """
+    fileList = sorted(glob.glob(run.path('Database/Staging/part-*.parquet')))
+
+    # Only the ids of every page are held at once, to find the last copy of each gift
+    ids = pa.concat_arrays([pq.read_table(file, columns=['id'])['id'].combine_chunks() for file in fileList] or
+                           [pa.array([], pa.string())])
+    position = pa.array(range(len(ids)), pa.int64())
+
+    last = pa.table({'id': ids, 'position': position}).group_by('id').aggregate([('position', 'max')])
+    keep = pc.is_in(position, last['position_max'])
+
+    offset = 0
+    for file in fileList:
+        table = pq.read_table(file, columns=columns, schema=GIFT_STORE_SCHEMA)
+
+        yield table.filter(keep.slice(offset, table.num_rows))
+
+        offset += table.num_rows
+
+def count_staged_gifts(run):
+    return sum(table.num_rows for table in read_staged_gifts(run, columns=['id']))
+
+def decode_gifts(run, gifts):
+    """
+    Decode gifts from an API response straight into GIFT_SCHEMA, fields outside the schema are dropped
+    """
+    table = pa.Table.from_pylist(gifts, schema=GIFT_WIRE_SCHEMA)
+
+    # Pre-process data
+    return process_data(run, table.cast(GIFT_SCHEMA).flatten(), table['date_added'])
+
+def stage_page(run, response, page):
+    if not response['value']:
+        return
+
+    run.log.hot('Staging page', page=page, rows=len(response['value']))
+
+    # Each page becomes its own Parquet file (a single row group), so only one page is ever held in memory
+    pq.write_table(decode_gifts(run, response['value']), run.path(f'Database/Staging/part-{page:06d}.parquet.tmp'))
+
+    # Renamed into place once complete, so a page that exists on disk is always whole
+    os.replace(run.path(f'Database/Staging/part-{page:06d}.parquet.tmp'), run.path(f'Database/Staging/part-{page:06d}.parquet'))
+
+def read_checkpoint(run):
+    try:
+        with open(run.path('Database/Staging/checkpoint.json')) as checkpoint_file:
+            checkpoint = json.load(checkpoint_file)
+
+    except (FileNotFoundError, json.JSONDecodeError):
+        checkpoint = {}
+
+    return checkpoint
+
+def save_checkpoint(run, checkpoint):
+    with open(run.path('Database/Staging/checkpoint.json.tmp'), 'w') as checkpoint_file:
+        json.dump(checkpoint, checkpoint_file, indent=4)
+
+    os.replace(run.path('Database/Staging/checkpoint.json.tmp'), run.path('Database/Staging/checkpoint.json'))
+
+def resume_checkpoint(run, url, mode):
+    """
+    Checkpoint of an interrupted pull of the same list in the same mode, or a fresh one with staging cleared
+    """
+    checkpoint = read_checkpoint(run)
+
+    # Only recent enough pulls are resumed, for their next_link and offsets to still hold
+    if checkpoint.get('url') == url and checkpoint.get('mode') == mode and \
+            datetime.now() - datetime.fromisoformat(checkpoint['started']) < timedelta(days=1):
+        run.log.info('Resuming interrupted pull', **checkpoint)
+
+        return checkpoint
+
+    clear_staging(run)
+    os.makedirs(run.path('Database/Staging'))
+
+    return {
+        'url': url,
+        'mode': mode,
+        'started': datetime.now().isoformat()
+    }
+
+def pagination_api_request(run, url, params):
+    run.log.info('Streaming paginated API response to Parquet')
+
+    checkpoint = resume_checkpoint(run, url, 'next_link')
+    checkpoint.setdefault('page', 0)
+    checkpoint.setdefault('rows', 0)
+    checkpoint.setdefault('next_link', url)
+
+    url = checkpoint['next_link']
+
+    with run.stats.stage('pagination_api_request') as stage:
+        # Pagination request to retreive list
+        while url:
+            # Blackbaud API GET request
+            response = get_request_re(run, url, params)
+
+            checkpoint['page'] += 1
+            stage_page(run, {'value': response['value']}, checkpoint['page'])
+
+            # Page is on disk before the checkpoint moves past it
+            url = response.get('next_link')
+
+            checkpoint['rows'] += len(response['value'])
+            checkpoint['next_link'] = url
+            save_checkpoint(run, checkpoint)
+
+            stage['rows_out'] += len(response['value'])
+
+def parallel_api_request(run, url, params, limit=500):
+    """
+    Fetch a list by limit/offset pages, RE_CONCURRENCY at a time, instead of following next_link one page after the
+    other. Returns the record count RE reported on the first page.
+    """
+    run.log.info('Fetching paginated API response in parallel offset ranges')
+
+    checkpoint = resume_checkpoint(run, url, 'offset')
+
+    with run.stats.stage('parallel_api_request') as stage:
+        # First page tells how many records there are to fetch
+        if 'count' not in checkpoint:
+            response = get_request_re(run, f'{url}&limit={limit}&offset=0', params)
+            stage_page(run, {'value': response['value']}, 1)
+
+            stage['rows_out'] = len(response['value'])
+
+            checkpoint['count'] = response['count']
+            save_checkpoint(run, checkpoint)
+
+        # Pages already on disk from an interrupted run are not fetched again
+        offsets = [
+            offset for offset in range(limit, checkpoint['count'], limit)
+            if not os.path.exists(run.path(f'Database/Staging/part-{offset // limit + 1:06d}.parquet'))
+        ]
+
+        def fetch_page(offset):
+            response = get_request_re(run, f'{url}&limit={limit}&offset={offset}', params)
+            stage_page(run, {'value': response['value']}, offset // limit + 1)
+
+            return len(response['value'])
+
+        with ThreadPoolExecutor(max_workers=run.re_concurrency) as executor:
+            stage['rows_out'] += sum(executor.map(fetch_page, offsets))
+
+    return checkpoint['count']
+
+def set_locale(run):
+    run.log.info('Setting Locale')
+
+    try:
+        # Setting Locale
+        locale.setlocale(locale.LC_ALL, 'en_IN.UTF-8')
+
+    except:
+        pass
+
+# Templates are compiled once on import, autoescape keeps donor and project names from breaking the HTML
+TEMPLATES = jinja2.Environment(autoescape=True, trim_blocks=True, lstrip_blocks=True)
+
+# Same look as pretty_html_table's 'blue_dark' theme, with every style inline as email clients drop <style> blocks
+TABLE_TEMPLATE = TEMPLATES.from_string('''
+{% set cell = 'font-family: Open Sans, Helvetica, Arial, sans-serif;font-size: 16px;text-align: left;padding: 10px;width: 700px' %}
+<p><table class="dataframe">
+  <thead>
+    <tr style="text-align: right;">
+{% for column in columns %}
+      <th style = "background-color: #305496;font-family: Open Sans, Helvetica, Arial, sans-serif;font-size: 16px;color: #FFFFFF;text-align: left;border-bottom: 2px solid #305496;padding: 10px;width: 700px">{{ column }}</th>
+{% endfor %}
+    </tr>
+  </thead>
+  <tbody>
+{% for row in rows %}
+{% set background = loop.cycle('#D9E1F2', 'white') %}
+    <tr>
+{% for value in row %}
+      <td style = "background-color: {{ background }}; color: black;{{ cell }}">{{ value }}</td>
+{% endfor %}
+    </tr>
+{% endfor %}
+{% if more_rows %}
+    <tr>
+      <td colspan="{{ columns | length }}" style = "background-color: white; color: black;font-style: italic;{{ cell }}">{{ '{:,}'.format(more_rows) }} {{ more_rows_label }}</td>
+    </tr>
+{% endif %}
+  </tbody>
+</table></p>
+''')
+
+def prepare_report(data, max_rows=None, more_rows_label='more rows'):
+    """
+    DONATION data as an HTML table, showing at most max_rows rows followed by a count of the rest
+    :return:
+    """
+    data = pd.DataFrame(data)
+
+    shown = data if max_rows is None else data.head(max_rows)
+
+    report_output = TABLE_TEMPLATE.render(
+        columns=data.columns,
+        rows=shown.itertuples(index=False, name=None),
+        more_rows=len(data) - len(shown),
+        more_rows_label=more_rows_label
+    )
+
+    return markupsafe.Markup(report_output)
+
+class FiscalCalendar:
+    """
+    Financial years run April to March and are named after the year they start in, e.g. 2024 for April 2024 to March
+    2025. Dates go into integer year, month and week buckets with vectorized arithmetic, so a report window is an
+    integer comparison on the buckets, or a slice of data sorted by date.
+    """
+
+    START_MONTH = 4
+
+    def __init__(self, today=None):
+        self.today = pd.Timestamp('today' if today is None else today).normalize()
+
+        # A run in the first week of April still reports on the year just ended, so its last days aren't left out
+        self.financial_year = int(self.financial_years(pd.Series([self.today - timedelta(days=7)]))[0])
+        self.start = self.year_start(self.financial_year)
+
+        # Weekly gift list covers the seven days up to today
+        self.week_start = self.today - timedelta(days=7)
+
+    @classmethod
+    def year_start(cls, financial_year):
+        return pd.Timestamp(year=financial_year, month=cls.START_MONTH, day=1)
+
+    @classmethod
+    def financial_years(cls, dates):
+        """
+        Financial year of each date, of a pandas Series or an Arrow array
+        """
+        if isinstance(dates, (pa.Array, pa.ChunkedArray)):
+            return pc.subtract(pc.year(dates), pc.less(pc.month(dates), cls.START_MONTH).cast(pa.int64()))
+
+        return dates.dt.year - (dates.dt.month < cls.START_MONTH)
+
+    @classmethod
+    def buckets(cls, dates):
+        """
+        Financial year, month (1 for April) and week (1 for the seven days from April 1st) of each date
+        """
+        financial_year = cls.financial_years(dates)
+        year_start = pd.to_datetime(pd.DataFrame({'year': financial_year, 'month': cls.START_MONTH, 'day': 1}))
+
+        return {
+            'receipt_financial_year': financial_year.astype('int32'),
+            'receipt_month': ((dates.dt.month - cls.START_MONTH) % 12 + 1).astype('int8'),
+            'receipt_week': ((dates.dt.normalize() - year_start).dt.days // 7 + 1).astype('int8')
+        }
+
+    @classmethod
+    def month_name(cls, month):
+        return datetime(2000, (month + cls.START_MONTH - 2) % 12 + 1, 1).strftime('%B')
+
+    @classmethod
+    def calendar_year(cls, financial_year, month):
+        # January onwards fall in the calendar year after the one the financial year is named after
+        return financial_year + (month > 12 - cls.START_MONTH + 1)
+
+    @staticmethod
+    def window(data, start=None, end=None, column='receipt_date'):
+        """
+        Rows of data, sorted by column, dated from start up to but not including end, found by binary search
+        """
+        first = 0 if start is None else data[column].searchsorted(start, 'left')
+        last = len(data) if end is None else data[column].searchsorted(end, 'left')
+
+        return data.iloc[first:last]
+
+def get_timeline(run):
+    run.log.info('Identifying Current Year and Financial Year')
+
+    calendar = FiscalCalendar()
+
+    run.log.info('Reporting on Financial Year', financial_year=calendar.financial_year, today=calendar.today)
+
+    return calendar
+
+def get_sync_state(run):
+    run.log.info('Reading Sync state')
+
+    try:
+        with open(run.path('Database/sync_state.json')) as sync_state_file:
+            sync_state = json.load(sync_state_file)
+
+    except (FileNotFoundError, json.JSONDecodeError):
+        sync_state = {}
+
+    return sync_state
+
+def save_sync_state(run, sync_state):
+    run.log.info('Saving Sync state')
+
+    # Write to a temporary file first so that a crash never leaves a half-written state behind
+    with open(run.path('Database/sync_state.json.tmp'), 'w') as sync_state_file:
+        json.dump(sync_state, sync_state_file, indent=4)
+
+    os.replace(run.path('Database/sync_state.json.tmp'), run.path('Database/sync_state.json'))
+
+def has_gift_store(run):
+    if not os.path.isdir(run.path('Database/Gifts')):
+        return False
+
+    # A store written with an older schema is rebuilt rather than merged into
+    return ds.dataset(run.path('Database/Gifts'), format='parquet').schema.names == GIFT_STORE_SCHEMA.names
+
+def is_full_sync_due(run, sync_state):
+    """
+    A full reconcile is needed when there is no local store or watermark yet, or when the last full pull is older
+    than FULL_SYNC_DAYS. Only a full pull can catch gifts deleted in Raisers Edge.
+    """
+    if not has_gift_store(run) or not sync_state.get('last_modified'):
+        return True
+
+    last_full_sync = datetime.fromisoformat(sync_state['last_full_sync'])
+
+    return datetime.now() - last_full_sync >= timedelta(days=run.full_sync_days)
+
+def get_last_modified(data, sync_state):
+    # High-water mark is the latest modification already seen, not the time of the run
+    if data['date_modified'].isna().all():
+        return sync_state.get('last_modified')
+
+    last_modified = data['date_modified'].max().strftime('%Y-%m-%dT%H:%M:%SZ')
+
+    return max(last_modified, sync_state.get('last_modified') or last_modified)
+
+def write_gift_partitions(run, data, store=None, financial_years=()):
+    """
+    Write the gifts of each financial year over its partition, financial_years are also written when left empty
+    """
+    run.log.info('Writing Gifts partitioned by Financial Year')
+
+    store = store or run.path('Database/Gifts')
+
+    receipt_financial_year = FiscalCalendar.financial_years(data['receipt_date'])
+
+    # With no gifts to write there are no partitions, the store is still made so it can be swapped in empty
+    os.makedirs(store, exist_ok=True)
+
+    for financial_year in set(receipt_financial_year) | set(financial_years):
+        partition = data[receipt_financial_year == financial_year]
+
+        path = f'{store}/receipt_financial_year={financial_year}'
+        os.makedirs(path, exist_ok=True)
+
+        # Sorted receipt dates keep row group statistics tight for date filters within a year
+        partition.sort_values('receipt_date').to_parquet(f'{path}/part-0.parquet.tmp', index=False,
+                                                         schema=GIFT_STORE_SCHEMA)
+
+        os.replace(f'{path}/part-0.parquet.tmp', f'{path}/part-0.parquet')
+
+# Rows of a low-memory full sync held per financial year before they are written, and per step of the daily aggregate
+LOW_MEMORY_CHUNK = 16384
+
+def store_staged_gifts(run, store):
+    """
+    Write the staged gifts into a new store without holding them all at once. Pages stay in Arrow and go to the
+    partition of their year, only the columns of the daily aggregate are converted to pandas, a chunk at a time.
+    Returns the daily aggregate, and the latest modification of each page for the watermark. Unlike
+    write_gift_partitions, gifts within a year are kept in the order they were fetched.
+    """
+    run.log.info('Writing staged Gifts partitioned by Financial Year, a page at a time')
+
+    daily_donation = []
+    modified = []
+    chunk = []
+
+    def add_chunk():
+        daily_donation[:] = [sum_daily_donation(daily_donation + [
+            aggregate_daily_donation(pa.concat_tables(chunk).to_pandas())
+        ])]
+        chunk.clear()
+
+    def batches():
+        for table in read_staged_gifts(run):
+            receipt_financial_year = FiscalCalendar.financial_years(table['receipt_date'])
+
+            chunk.append(table.select(['date', 'receipt_date', 'campaign_id', 'amount.value']))
+            modified.append(pc.max(table['date_modified']).as_py())
+
+            if sum(part.num_rows for part in chunk) >= LOW_MEMORY_CHUNK:
+                add_chunk()
+
+            yield from table.append_column('receipt_financial_year', receipt_financial_year.cast(pa.int32())).to_batches()
+
+    ds.write_dataset(batches(), store, schema=GIFT_DATASET_SCHEMA, format='parquet', partitioning=GIFT_PARTITIONING,
+                     basename_template='part-{i}.parquet', min_rows_per_group=LOW_MEMORY_CHUNK,
+                     max_rows_per_group=LOW_MEMORY_CHUNK)
+
+    # One file per year, named like the ones write_gift_partitions writes over
+    for path in glob.glob(f'{store}/*/part-*.parquet'):
+        os.rename(path, os.path.join(os.path.dirname(path), 'part-0.parquet'))
+
+    # With no gifts at all nothing was written, the store is still swapped in empty and read with GIFT_DATASET_SCHEMA
+    os.makedirs(store, exist_ok=True)
+
+    if chunk or not daily_donation:
+        chunk.append(GIFT_STORE_SCHEMA.empty_table().select(['date', 'receipt_date', 'campaign_id', 'amount.value']))
+        add_chunk()
+
+    return daily_donation[0], pd.DataFrame({'date_modified': pd.to_datetime(modified, utc=True)})
+
+def read_donation(run, financial_year=None, columns=None):
+    """
+    Gifts received in or after financial_year (all gifts if None), only the partitions of those years are read
+    """
+    run.log.info('Reading Gifts received since Financial Year', financial_year=financial_year)
+
+    dataset = ds.dataset(run.path('Database/Gifts'), schema=GIFT_DATASET_SCHEMA, format='parquet',
+                         partitioning=GIFT_PARTITIONING)
+
+    if financial_year is None:
+        return dataset.to_table(columns=columns).to_pandas()
+
+    return dataset.to_table(columns=columns,
+                            filter=ds.field('receipt_financial_year') >= int(financial_year)).to_pandas()
 
-        else:
-            logging.info(result.get('error'))
-            logging.info(result.get('error_description'))
-            logging.info(result.get('correlation_id'))
+def upsert_donation(run, data, window_start=None):
+    """
+    Merge changed gifts into the local store, returns the stored versions that were replaced. With window_start, data
+    holds every gift dated from then on, so stored gifts in that window which are not in data are dropped.
+    """
+    run.log.info('Upserting changed Gifts into the local store')
 
-def print_json(d):
-    print(json.dumps(d, indent=4))
+    dataset = ds.dataset(run.path('Database/Gifts'), schema=GIFT_DATASET_SCHEMA, format='parquet',
+                         partitioning=GIFT_PARTITIONING)
 
+    replaced = ds.field('id').isin(data['id'].tolist())
 
-def retrieve_token():
-    logging.info('Retrieve token for API connections')
+    if window_start is not None:
+        replaced = replaced | (ds.field('date') >= pa.scalar(window_start, pa.timestamp('ns')))
 
-    with open('access_token_output.json') as access_token_output:
-        data = json.load(access_token_output)
-        access_token = data['access_token']
+    replaced = dataset.to_table(filter=replaced).to_pandas()
 
-    return access_token
+    if data.empty and replaced.empty:
+        return replaced
 
-def get_request_re(url, params):
-    logging.info('Running GET Request from RE function')
+    # Only the years holding a changed gift, before or after the change, are rewritten
+    financial_years = set(replaced['receipt_financial_year']) | set(FiscalCalendar.financial_years(data['receipt_date']))
 
-    global re_api_response
+    stored = dataset.to_table(filter=ds.field('receipt_financial_year').isin(financial_years)).to_pandas()
+    stored = stored[~stored['id'].isin(replaced['id'])].drop(columns='receipt_financial_year')
 
-    # Retrieve access_token from file
-    access_token = retrieve_token()
+    # Changed gifts replace their stored version, new gifts are appended
+    write_gift_partitions(run, pd.concat([stored, data], ignore_index=True), financial_years=financial_years)
 
-    # Request headers
-    headers = {
-        'Bb-Api-Subscription-Key': RE_API_KEY,
-        'Authorization': 'Bearer ' + access_token,
-    }
+    return replaced
 
-    re_api_response = http.get(url, params=params, headers=headers).json()
+def aggregate_daily_donation(data):
+    """
+    Gift totals per receipt day, financial year of the gift date and campaign
+    """
+    data = data.assign(
+        receipt_date=data['receipt_date'].dt.normalize(),
+        financial_year=FiscalCalendar.financial_years(data['date'])
+    )
 
-    return re_api_response
+    return bucket_daily_donation(data.groupby(['receipt_date', 'financial_year', 'campaign_id'], dropna=False).agg(
+        amount=('amount.value', 'sum'),
+        gifts=('amount.value', 'size')
+    ).reset_index())
 
-def post_request_re(url, params):
-    logging.info('Running POST Request to RE function')
+def bucket_daily_donation(daily):
+    """
+    Add the financial year, month and week of the receipt date, and sort by it for FiscalCalendar.window
+    """
+    # Buckets only depend on the day, so they are worked out once per day and campaign rather than per gift
+    return daily.assign(**FiscalCalendar.buckets(daily['receipt_date'])).sort_values(
+        'receipt_date', kind='stable', ignore_index=True)
 
-    # Retrieve access_token from file
-    access_token = retrieve_token()
+def update_daily_donation(run, changed, replaced):
+    run.log.info('Updating daily Donation aggregate')
 
-    # Request headers
-    headers = {
-        'Bb-Api-Subscription-Key': RE_API_KEY,
-        'Authorization': 'Bearer ' + access_token,
-        'Content-Type': 'application/json',
-    }
+    # A run that synced before, in 'Report Service.py', still has the aggregate in memory
+    if run.daily_donation is not None:
+        daily = run.daily_donation
+    else:
+        daily = pd.read_parquet(run.path('Database/Daily Donations.parquet'))
 
-    re_api_response = http.post(url, params=params, headers=headers, json=params).json()
+    # Aggregates saved before the buckets were added get them on the way through
+    if changed.empty and replaced.empty:
+        return bucket_daily_donation(daily)
 
-    return re_api_response
+    # Changed gifts are added in and the versions they replace are taken out, without touching any other gift
+    deltas = [daily, aggregate_daily_donation(changed)]
 
-def patch_request_re(url, params):
-    logging.info('Running PATCH Request to RE function')
+    if not replaced.empty:
+        reverse = aggregate_daily_donation(replaced)
+        deltas.append(reverse.assign(amount=-reverse['amount'], gifts=-reverse['gifts']))
 
-    # Retrieve access_token from file
-    access_token = retrieve_token()
+    return sum_daily_donation(deltas)
 
-    # Request headers
-    headers = {
-        'Bb-Api-Subscription-Key': RE_API_KEY,
-        'Authorization': 'Bearer ' + access_token,
-        'Content-Type': 'application/json'
-    }
+def sum_daily_donation(parts):
+    """
+    Add up daily aggregates of different sets of gifts, days left with no gift are dropped
+    """
+    daily = pd.concat(parts, ignore_index=True).groupby(
+        ['receipt_date', 'financial_year', 'campaign_id'], dropna=False).agg(
+        amount=('amount', 'sum'),
+        gifts=('gifts', 'sum')
+    ).reset_index()
+
+    daily['amount'] = daily['amount'].round(2)
+
+    return bucket_daily_donation(daily[daily['gifts'] != 0])
+
+# Weekly totals as each run reported them, kept in Database/Weekly Snapshots/ partitioned like the gifts. A week that
+# spans two months has a row for each, so both weekly and monthly totals can be added up from the snapshots.
+WEEKLY_SNAPSHOT_SCHEMA = pa.schema([
+    ('receipt_week', pa.int8()),
+    ('receipt_month', pa.int8()),
+    ('campaign_id', pa.string()),
+    ('amount', pa.float64()),
+    ('gifts', pa.int64()),
+    ('snapshot_date', pa.timestamp('ns'))
+])
+
+SNAPSHOT_KEY = ['receipt_financial_year', 'receipt_week', 'receipt_month', 'campaign_id']
+
+# Snapshot files of the current financial year are compacted into one when there are more than this, earlier years
+# as soon as they have more than one
+SNAPSHOT_COMPACT_FILES = 8
+
+def read_weekly_snapshots(run, tombstones=False):
+    """
+    Latest snapshot of every week, month and campaign. Rows that went away are snapshotted with no gifts, and are
+    only returned with tombstones.
+    """
+    try:
+        data = ds.dataset(run.path('Database/Weekly Snapshots'), format='parquet',
+                          partitioning=GIFT_PARTITIONING).to_table().to_pandas()
 
-    re_api_response = http.patch(url, headers=headers, data=json.dumps(params))
+    except FileNotFoundError:
+        data = WEEKLY_SNAPSHOT_SCHEMA.empty_table().to_pandas().assign(
+            receipt_financial_year=pd.Series(dtype='int32'))
 
-    return re_api_response
+    data = data.sort_values('snapshot_date', kind='stable').drop_duplicates(SNAPSHOT_KEY, keep='last')
 
+    return data if tombstones else data[data['gifts'] != 0]
 
-def load_from_json_to_parquet():
-    logging.info('Loading from JSON to Parquet file')
+def write_weekly_snapshot(run, data, financial_year, name):
+    path = run.path(f'Database/Weekly Snapshots/receipt_financial_year={financial_year}')
+    os.makedirs(path, exist_ok=True)
 
-    # Get a list of all the file paths that ends with wildcard from in specified directory
-    fileList = glob.glob('API_Response_RE_*.json')
+    pq.write_table(pa.Table.from_pandas(data, schema=WEEKLY_SNAPSHOT_SCHEMA, preserve_index=False),
+                   f'{path}/{name}.parquet.tmp')
+    os.replace(f'{path}/{name}.parquet.tmp', f'{path}/{name}.parquet')
 
-    df = pd.DataFrame()
+def save_weekly_snapshot(run, daily_donation):
+    """
+    Append the weekly totals that changed since the last snapshot, then compact the years with too many snapshot
+    files. Returns the latest snapshot of every week.
+    """
+    run.log.info('Saving weekly Snapshot')
 
-    for each_file in fileList:
-        # Open Each JSON File
-        with open(each_file, 'r', encoding='utf8') as json_file:
-            # Load JSON File
-            json_content = json.load(json_file)
+    with run.stats.stage('weekly snapshot', rows_in=len(daily_donation)) as stage:
+        snapshot_date = datetime.now()
 
-            # Convert non-string values to strings
-            json_content = convert_to_strings(json_content)
+        current = daily_donation.groupby(SNAPSHOT_KEY, dropna=False).agg(
+            amount=('amount', 'sum'),
+            gifts=('gifts', 'sum')
+        ).reset_index()
 
-            # Load to a dataframe
-            df_ = api_to_df(json_content)
+        merged = current.merge(read_weekly_snapshots(run), on=SNAPSHOT_KEY, how='outer', suffixes=('', '_snapshot'),
+                               indicator=True)
 
-            df = pd.concat([df, df_])
+        # New or changed totals are appended, and totals that went away are appended with no gifts
+        changed = (merged['_merge'] == 'left_only') | (merged['_merge'] == 'both') & (
+            ((merged['amount'] - merged['amount_snapshot']).abs() >= 0.005) | (merged['gifts'] != merged['gifts_snapshot']))
 
-    housekeeping()
+        removed = merged['_merge'] == 'right_only'
+        merged.loc[removed, ['amount', 'gifts']] = 0
 
-    return df
+        delta = merged[changed | removed].assign(snapshot_date=snapshot_date)
 
-def convert_to_strings(obj):
-    """
-    Recursively convert non-string values to strings in a dictionary
-    """
-    if isinstance(obj, dict):
-        return {k: convert_to_strings(v) for k, v in obj.items()}
-    elif isinstance(obj, list):
-        return [convert_to_strings(item) for item in obj]
-    else:
-        return str(obj)
+        for financial_year, data in delta.groupby('receipt_financial_year'):
+            write_weekly_snapshot(run, data, financial_year, f'snapshot-{snapshot_date:%Y%m%d%H%M%S}')
 
+        stage['rows_out'] = len(delta)
 
-def api_to_df(response):
-    logging.info('Loading API response to a DataFrame')
+        compact_weekly_snapshots(run)
 
-    # Load from JSON to pandas
-    try:
-        api_response = pd.json_normalize(response['value'])
-    except:
-        try:
-            api_response = pd.json_normalize(response)
-        except:
-            api_response = pd.json_normalize(response, 'value')
+    return read_weekly_snapshots(run)
 
-    # Load to a dataframe
-    df = pd.DataFrame(data=api_response)
+def compact_weekly_snapshots(run):
+    for path in glob.glob(run.path('Database/Weekly Snapshots/receipt_financial_year=*')):
+        financial_year = int(path.rsplit('=', 1)[1])
+        files = glob.glob(f'{path}/*.parquet')
 
-    return df
+        limit = SNAPSHOT_COMPACT_FILES if financial_year >= run.calendar.financial_year else 1
 
-def pagination_api_request(url, params):
-    # Pagination request to retreive list
-    while url:
-        # Blackbaud API GET request
-        get_request_re(url, params)
+        if len(files) <= limit:
+            continue
 
-        # Incremental File name
-        i = 1
-        while os.path.exists(f'API_Response_RE_{process_name}_{i}.json'):
-            i += 1
+        run.log.info('Compacting weekly Snapshots', financial_year=financial_year, files=len(files))
 
-        with open(f'API_Response_RE_{process_name}_{i}.json', 'w', encoding='utf-8') as list_output:
-            json.dump(re_api_response, list_output, ensure_ascii=True, sort_keys=True, indent=4)
+        # Superseded versions are dropped, rows with no gifts are kept so they still hide older versions should a
+        # crash leave some of the old files behind
+        data = pd.concat([pd.read_parquet(file) for file in files], ignore_index=True)
+        data = data.sort_values('snapshot_date', kind='stable').drop_duplicates(SNAPSHOT_KEY[1:], keep='last')
 
-        # Check if a variable is present in file
-        with open(f'API_Response_RE_{process_name}_{i}.json') as list_output_last:
+        write_weekly_snapshot(run, data, financial_year, 'compacted')
 
-            if 'next_link' in list_output_last.read():
-                url = re_api_response['next_link']
+        for file in files:
+            if os.path.basename(file) != 'compacted.parquet':
+                os.remove(file)
 
-            else:
-                break
+def get_donation(run):
+    run.log.info('Getting all Gifts from Raisers Edge')
 
-def set_locale():
-    logging.info('Setting Locale')
+    sync_state = get_sync_state(run)
+    full_sync = is_full_sync_due(run, sync_state)
+    window_start = None
 
-    try:
-        # Setting Locale
-        locale.setlocale(locale.LC_ALL, 'en_IN.UTF-8')
+    url = f'{run.re_api_url}/gift/v1/gifts?gift_type=Donation&gift_type=MatchingGiftPayment&gift_type=PledgePayment&gift_type=RecurringGiftPayment&gift_type=GiftInKind'
+    params = {}
 
-    except:
-        pass
+    # Report-only runs fetch just the gifts the report can need, anything older comes from the local store
+    if run.report_only and has_gift_store(run):
+        full_sync = False
+        window_start = run.calendar.start - timedelta(days=run.receipt_lookback_days)
 
-def prepare_report(data):
-    """
-    DONATION data
-    :return:
-    """
-    data = pd.DataFrame(data)
+        run.log.info('Running a report-only sync of Gifts', dated_from=window_start)
+        url += f'&start_gift_date={window_start:%Y-%m-%d}'
 
-    report_output = (
-        build_table(data, 'blue_dark', font_family='Open Sans, Helvetica, Arial, sans-serif', even_color='black',
-                    padding='10px', width='700px', font_size='16px')).replace(
-        "background-color: #D9E1F2;font-family: Open Sans",
-        "background-color: #D9E1F2; color: black;font-family: Open Sans")
+    elif full_sync:
+        run.log.info('Running a full sync of Gifts')
+    else:
+        run.log.info('Running an incremental sync of Gifts', modified_since=sync_state['last_modified'])
+        url += '&last_modified=' + quote(sync_state['last_modified'])
+
+    # A full pull is spread over parallel offset ranges, a small incremental one just follows next_link
+    if full_sync and run.re_concurrency > 1:
+        count = parallel_api_request(run, url, params)
+        fetched = count_staged_gifts(run)
 
-    return report_output
+        # Gifts added or deleted while the pages were being fetched shift the offsets, so redo it the safe way
+        if fetched != count:
+            run.log.warning('Fetched fewer Gifts than RE reported, fetching again by next_link', fetched=fetched, count=count)
 
-def get_timeline():
-    logging.info('Identifying Current Year and Financial Year')
+            pagination_api_request(run, url, params)
 
-    current_month = datetime.now().strftime("%m")
+    else:
+        pagination_api_request(run, url, params)
 
-    current_year = datetime.now().strftime("%Y")
+    # The store, the daily aggregate and the watermark are written one after the other. Should a run die in between,
+    # the next one finds this still set and rebuilds the aggregate from the store rather than adjusting it, as the
+    # gifts it fetches again would already be in the store and cancel out.
+    store_pending = sync_state.get('store_pending', False)
+    sync_state['store_pending'] = True
+    save_sync_state(run, sync_state)
 
-    current_date = datetime.now().strftime("%d")
+    # A low-memory full sync goes from staging to the store a page at a time, data only holds what the watermark needs
+    if full_sync and run.low_memory:
+        with run.stats.stage('store gifts') as stage:
+            sync_state['last_full_sync'] = datetime.now().isoformat()
 
-    # Determining the current Financial Year to determine Start date
-    if int(current_month) <= 4:
+            shutil.rmtree(run.path('Database/Gifts.tmp'), ignore_errors=True)
+            daily_donation, data = store_staged_gifts(run, run.path('Database/Gifts.tmp'))
+            shutil.rmtree(run.path('Database/Gifts'), ignore_errors=True)
+            os.rename(run.path('Database/Gifts.tmp'), run.path('Database/Gifts'))
 
-        if int(current_month) == 4 and int(current_date) > 7:
-            financial_year = current_year
+            stage['rows_out'] = int(daily_donation['gifts'].sum())
 
-        else:
-            financial_year = int(datetime.now().strftime("%Y")) - 1
     else:
-        financial_year = current_year
+        data = load_from_staging(run)
 
-    start_gift_date = '01-Apr-' + str(financial_year)
+        with run.stats.stage('store gifts', rows_in=len(data)) as stage:
+            if full_sync:
+                sync_state['last_full_sync'] = datetime.now().isoformat()
 
-    return current_date, current_month, current_year, financial_year, start_gift_date
+                # Build the new store next to the old one and swap, so a failed run never leaves half a store behind
+                shutil.rmtree(run.path('Database/Gifts.tmp'), ignore_errors=True)
+                write_gift_partitions(run, data, run.path('Database/Gifts.tmp'))
+                shutil.rmtree(run.path('Database/Gifts'), ignore_errors=True)
+                os.rename(run.path('Database/Gifts.tmp'), run.path('Database/Gifts'))
 
-def get_donation():
-    logging.info('Getting all Gifts from Raisers Edge')
+            else:
+                replaced = upsert_donation(run, data, window_start)
 
-    url = f'https://api.sky.blackbaud.com/gift/v1/gifts?gift_type=Donation&gift_type=MatchingGiftPayment&gift_type=PledgePayment&gift_type=RecurringGiftPayment&gift_type=GiftInKind'
-    params = {}
+            stage['rows_out'] = len(data)
 
-    pagination_api_request(url, params)
+    # Daily aggregate is rebuilt on a full sync (a low-memory one built it while storing) and only adjusted for the
+    # changed gifts otherwise
+    if full_sync:
+        if not run.low_memory:
+            daily_donation = aggregate_daily_donation(data)
+    elif store_pending or not os.path.exists(run.path('Database/Daily Donations.parquet')):
+        run.log.info('Rebuilding daily Donation aggregate from the local store', store_pending=store_pending)
 
-    data = load_from_json_to_parquet().copy()
+        daily_donation = aggregate_daily_donation(
+            read_donation(run, columns=['date', 'receipt_date', 'campaign_id', 'amount.value']))
+    else:
+        daily_donation = update_daily_donation(run, data, replaced)
 
-    data.to_parquet('Database/Data.parquet', index=False)
+    daily_donation.to_parquet(run.path('Database/Daily Donations.parquet'), index=False)
 
-    # Pre-process data
-    data = process_data(data).copy()
+    # A report-only pull says nothing about older gifts changed since the watermark, so it stays where it was
+    if window_start is None:
+        sync_state['last_modified'] = get_last_modified(data, sync_state)
 
-    return data
+    del sync_state['store_pending']
+    save_sync_state(run, sync_state)
 
-def process_data(data):
-    logging.info('Pre-process Donation data')
+    # Staged pages are only dropped once they are safely in the store
+    clear_staging(run)
 
-    # Amount
-    data['amount.value'] = pd.to_numeric(data['amount.value'])
+    return daily_donation
 
-    # Dates
-    data['date'] = pd.to_datetime(data['date'])
-    data['date_added'] = pd.to_datetime(data['date_added'], format='ISO8601')
-    data['receipt_date'] = data['receipts'].apply(lambda x: get_dates(x))
-    data['receipt_date'] = data['receipt_date'].fillna(data['date_added'].astype(str) + 'T00:00:00')
-    data['receipt_date'] = data['receipt_date'].apply(lambda x: str(x).split(' ')[0])
-    data['receipt_date'] = pd.to_datetime(data['receipt_date'], format='mixed', dayfirst=False)
+def process_data(run, data, date_added):
+    """
+    Add receipt_date and campaign_id to an Arrow table of gifts. date_added is the column as RE sent it, before it was
+    converted to UTC.
+    """
+    # Once per staged page, so only sampled
+    run.log.hot('Pre-process Donation data', rows=data.num_rows)
 
-    # Campaign ID
-    data['campaign_id'] = data['gift_splits'].apply(lambda x: x[0]['campaign_id'])
+    with run.stats.stage('process_data', rows_in=data.num_rows) as stage:
+        # Dates, gifts without a receipt fall back to the date they were added on, in the offset RE gave it in
+        # rather than that of this machine
+        date_added = pc.strptime(pc.utf8_slice_codeunits(date_added, 0, 10), format='%Y-%m-%d', unit='ns')
 
-    return data
+        receipt_date = pc.coalesce(pc.struct_field(first_item(data['receipts']), 'date'), date_added)
 
-def get_dates(value):
-    try:
-        date = value[0]['date']
-    except:
-        date = np.NaN
+        # Campaign ID
+        campaign_id = pc.struct_field(first_item(data['gift_splits']), 'campaign_id')
+
+        data = data.append_column('receipt_date', receipt_date).append_column('campaign_id', campaign_id)
+
+        stage['rows_out'] = data.num_rows
 
-    return date
+    return data
+
+def first_item(column):
+    # list_element fails on empty lists, slicing to a fixed size of one pads those with null instead
+    return pc.list_element(pc.list_slice(column, 0, 1, return_fixed_size_list=True), 0)
 
-def get_ytd_donation():
-    logging.info('Getting YTD Gifts from Raisers Edge')
+def get_ytd_donation(run, daily_donation):
+    run.log.info('Getting YTD Gifts from Raisers Edge')
 
-    amount = re_donation[
-        (re_donation['receipt_date'] >= start_gift_date)
-        ]['amount.value'].sum()
+    amount = daily_donation[
+        daily_donation['receipt_financial_year'] >= run.calendar.financial_year
+        ]['amount'].sum()
 
     if len(str(round(amount))) >= 10:
         amount = locale.currency(round(amount), grouping=True)[:-3]
@@ -464,7 +1737,7 @@ def get_ytd_donation():
         amount = locale.currency(round(amount), grouping=True)[:-3]
 
     amount = {
-        'Financial Year': "F.Y. " + str(financial_year) + ' - ' + str(int(str(financial_year)[-2:]) + 1),
+        'Financial Year': f'F.Y. {run.calendar.financial_year} - {(run.calendar.financial_year + 1) % 100:02d}',
         'Amount': [amount]
     }
 
@@ -472,13 +1745,13 @@ def get_ytd_donation():
 
     return amount
 
-def get_previous_year_donations():
-    logging.info('Getting YTD Gifts donated in the previous financial years from Raisers Edge')
+def get_previous_year_donations(run, daily_donation):
+    run.log.info('Getting YTD Gifts donated in the previous financial years from Raisers Edge')
 
-    amount = re_donation[
-        (re_donation['receipt_date'] >= start_gift_date) &
-        (re_donation['date'] < start_gift_date)
-    ]['amount.value'].sum()
+    amount = daily_donation[
+        (daily_donation['receipt_financial_year'] >= run.calendar.financial_year) &
+        (daily_donation['financial_year'] < run.calendar.financial_year)
+    ]['amount'].sum()
 
     if len(str(round(amount))) >= 10:
         amount = locale.currency(round(amount), grouping=True)[:-3]
@@ -495,124 +1768,490 @@ def get_previous_year_donations():
 
     return amount
 
-def get_monthly_donation():
-    logging.info('Getting Monthly Gifts from Raisers Edge')
+def get_monthly_donation(run, daily_donation):
+    run.log.info('Getting Monthly Gifts from Raisers Edge')
 
-    data = re_donation[
-        (re_donation['receipt_date'] >= start_gift_date)
-        ][['receipt_date', 'amount.value']].reset_index(drop=True).copy()
+    data = daily_donation[
+        daily_donation['receipt_financial_year'] >= run.calendar.financial_year
+        ].groupby(['receipt_financial_year', 'receipt_month']).agg({'amount': 'sum'}).reset_index()
 
-    data['receipt_date'] = pd.to_datetime(data['receipt_date'], format='%d-%b-%Y')
-    data['receipt_date'] = data['receipt_date'].dt.strftime('%B')
+    data = data[data['amount'] > 0]
 
-    data = data.rename(columns={
-        'receipt_date': 'Month',
-        'amount.value': 'Amount'
-    }).copy()
-
-    months = [
-        'January',
-        'February',
-        'March',
-        'April',
-        'May',
-        'June',
-        'July',
-        'August',
-        'September',
-        'October',
-        'November',
-        'December'
-    ]
+    # Months in the order of the financial year, the first days of the next one are there in the first week of April
+    data = pd.DataFrame({
+        'Month': [
+            FiscalCalendar.month_name(month) + ('' if year == run.calendar.financial_year else f' {FiscalCalendar.calendar_year(year, month)}')
+            for year, month in zip(data['receipt_financial_year'], data['receipt_month'])
+        ],
+        'Amount': data['amount'].apply(lambda x: locale.currency(round(x), grouping=True)[:-3])
+    })
 
-    data['Month'] = pd.Categorical(data['Month'], categories=months, ordered=True)
+    data = prepare_report(data)
 
-    data = data.groupby('Month').agg({'Amount': 'sum'}).dropna().reset_index().copy()
+    return data
 
-    data = data[data['Amount'] > 0].reset_index(drop=True).copy()
+def to_currency(amount):
+    return locale.currency(round(amount), grouping=True)[:-3]
 
-    data['Amount'] = data['Amount'].apply(lambda x: locale.currency(round(x), grouping=True)[:-3])
+def get_change(amount, previous):
+    return f'{amount / previous - 1:+.0%}' if previous else '-'
 
-    data = prepare_report(data)
+# Weeks the year-over-year weekly section goes back
+YOY_WEEKS = 8
 
-    return data
+def get_yoy_weekly_donation(run, snapshots):
+    run.log.info('Getting Weekly Gifts against the same weeks last year from Snapshots')
+
+    buckets = FiscalCalendar.buckets(pd.Series([run.calendar.today]))
+    financial_year, week = int(buckets['receipt_financial_year'][0]), int(buckets['receipt_week'][0])
+
+    weeks = snapshots.groupby(['receipt_financial_year', 'receipt_week'])['amount'].sum()
+
+    rows = []
+    for week in range(week, max(week - YOY_WEEKS, 0), -1):
+        amount = weeks.get((financial_year, week), 0)
+        previous = weeks.get((financial_year - 1, week), 0)
+
+        rows.append({
+            'Week': f'Week {week} from '
+                    f'{FiscalCalendar.year_start(financial_year) + timedelta(days=7 * (week - 1)):%d-%b-%Y}',
+            'This Year': to_currency(amount),
+            'Last Year': to_currency(previous),
+            'Change': get_change(amount, previous)
+        })
+
+    return prepare_report(pd.DataFrame(rows))
+
+def get_yoy_monthly_donation(run, snapshots):
+    run.log.info('Getting Monthly Gifts against the same months last year from Snapshots')
+
+    financial_year = run.calendar.financial_year
+
+    months = snapshots.groupby(['receipt_financial_year', 'receipt_month'])['amount'].sum()
+
+    rows = []
+    for month in sorted(months[financial_year].index if financial_year in months.index else []):
+        amount = months.get((financial_year, month), 0)
+        previous = months.get((financial_year - 1, month), 0)
+
+        rows.append({
+            'Month': FiscalCalendar.month_name(month),
+            'This Year': to_currency(amount),
+            'Last Year': to_currency(previous),
+            'Change': get_change(amount, previous)
+        })
+
+    return prepare_report(pd.DataFrame(rows, columns=['Month', 'This Year', 'Last Year', 'Change']))
 
-def get_weekly_donation():
-    logging.info('Getting Weekly Gift list from Raisers Edge')
+def get_rolling_donation(run, daily_donation):
+    run.log.info('Getting rolling 52 week Gifts')
 
-    data = re_donation[
-        (re_donation['receipt_date'] >= (pd.to_datetime('today') - timedelta(days=7)).strftime('%d-%b-%Y')) &
-        (re_donation['receipt_date'] >= start_gift_date)
-        ][[
+    # Windows of 52 weeks to the day, as week 53 of a financial year is only its last day or two
+    end = run.calendar.today + timedelta(days=1)
+    start = end - timedelta(weeks=52)
+
+    amount = FiscalCalendar.window(daily_donation, start, end)['amount'].sum()
+    previous = FiscalCalendar.window(daily_donation, start - timedelta(weeks=52), start)['amount'].sum()
+
+    return prepare_report({
+        'Period': ['Last 52 weeks', 'The 52 weeks before'],
+        'Amount': [to_currency(amount), to_currency(previous)],
+        'Change': [get_change(amount, previous), '']
+    })
+
+def get_weekly_gifts(run):
+    run.log.info('Getting Weekly Gifts with Donor and Project names')
+
+    # re_donation is sorted by receipt date, so the week is a slice of it
+    data = FiscalCalendar.window(run.re_donation, max(run.calendar.week_start, run.calendar.start))[[
         'receipt_date', 'amount.value', 'constituent_id', 'campaign_id'
-    ]].reset_index(drop=True).copy()
+    ]].reset_index(drop=True)
+
+    # Names come from the local Constituents and Campaigns tables, synced before any report is built
+    data = data.merge(run.constituents[['constituent_id', 'name']].rename(columns={'name': 'Name of Donor'}),
+                      on='constituent_id', how='left')
+    data = data.merge(run.campaigns[['campaign_id', 'name']].rename(columns={'name': 'Purpose/ Project Description'}),
+                      on='campaign_id', how='left')
+
+    # Largest gifts first within a day, so the list doesn't depend on the order gifts are stored in
+    data = data.sort_values(['receipt_date', 'amount.value'], ascending=False)
+
+    return data
 
-    data = data.sort_values(['receipt_date'], ascending=False).copy()
-    data['receipt_date'] = data['receipt_date'].dt.strftime('%d-%b-%Y')
+def get_weekly_donation(run, weekly_gifts):
+    run.log.info('Getting Weekly Gift list from Raisers Edge')
 
-    data['Name of Donor'] = data['constituent_id'].apply(lambda x: get_donor_name(x))
-    data['Purpose/ Project Description'] = data['campaign_id'].apply(lambda x: get_project(x))
+    data = weekly_gifts
 
-    data = data.rename(columns={
+    # Too many gifts to list inline, the largest are shown and the full list is attached
+    if len(data) > run.report_max_rows:
+        data = data.sort_values('amount.value', ascending=False, kind='stable')
+
+    # Dropping the ids gives a new frame, so the shared weekly_gifts is never written to
+    data = data.drop(columns=['constituent_id', 'campaign_id']).rename(columns={
         'receipt_date': 'Date of Credit',
         'amount.value': 'Amount'
-    }).copy()
+    })
 
-    data = data.drop(columns=['constituent_id', 'campaign_id']).copy()
+    data['Date of Credit'] = data['Date of Credit'].dt.strftime('%d-%b-%Y')
 
     data['Amount'] = data['Amount'].apply(lambda x: locale.currency(round(x), grouping=True)[:-3])
 
-    data = prepare_report(data)
+    data = prepare_report(data, run.report_max_rows, 'smaller gifts in the attached Weekly Gifts.zip')
 
     return data
 
-def get_donor_name(id):
-    logging.info('Getting Donor Name')
+# Sections a report can be made of, in the order they appear in the email
+REPORT_SECTIONS = {
+    'ytd': get_ytd_donation,
+    'previous_ytd': get_previous_year_donations,
+    'monthly': get_monthly_donation,
+    'yoy_monthly': get_yoy_monthly_donation,
+    'yoy_weekly': get_yoy_weekly_donation,
+    'rolling': get_rolling_donation,
+    'weekly': get_weekly_donation
+}
+
+# Sections of a report that doesn't list its own
+DEFAULT_SECTIONS = ['ytd', 'previous_ytd', 'monthly', 'weekly']
+
+# Frame of the run each section is cut from, fy_daily_donation for the rest
+REPORT_SECTION_DATA = {
+    'yoy_monthly': 'weekly_snapshots',
+    'yoy_weekly': 'weekly_snapshots',
+    'rolling': 'daily_donation',
+    'weekly': 'weekly_gifts'
+}
+
+# Fields a report can be filtered on, present in the daily aggregate, the weekly snapshots and the weekly gift list
+REPORT_FILTERS = ['campaign_id']
+
+def load_report_definitions(run):
+    """
+    Reports to send from Reports.json, or the single all-gifts report to SEND_TO/CC_TO when there is none
+    """
+    run.log.info('Loading Report definitions')
+
+    try:
+        with open(run.path('Reports.json')) as reports_file:
+            reports = json.load(reports_file)
+
+    except FileNotFoundError:
+        reports = [
+            {
+                'name': 'Donation Summary',
+                'send_to': run.send_to,
+                'cc_to': run.cc_to
+            }
+        ]
 
-    url = f'https://api.sky.blackbaud.com/constituent/v1/constituents/{id}'
-    params = {}
+    for report in reports:
+        report.setdefault('subject', 'Donation Summary | Raisers Edge')
+        report.setdefault('filters', {})
+        report.setdefault('sections', DEFAULT_SECTIONS)
+        report.setdefault('cc_to', [])
+
+        unknown = set(report['sections']) - set(REPORT_SECTIONS) | set(report['filters']) - set(REPORT_FILTERS)
+
+        if unknown:
+            raise ValueError(f'Unknown sections or filters in report {report["name"]}: {", ".join(sorted(unknown))}')
+
+    return reports
+
+def filter_donation(data, filters):
+    for field, values in filters.items():
+        data = data[data[field].isin(values)]
+
+    return data
+
+def render_report(run, report):
+    """
+    HTML of each section of a report. Every report is cut from the same shared frames, and a section already rendered
+    for the same filters by an earlier report is reused as is.
+    """
+    run.log.info('Rendering report', report=report['name'])
+
+    filters = json.dumps(report['filters'], sort_keys=True)
+
+    sections = {}
+    for section, get_section in REPORT_SECTIONS.items():
+        if section not in report['sections']:
+            continue
+
+        if (section, filters) not in run.rendered_sections:
+            data = filter_donation(getattr(run, REPORT_SECTION_DATA.get(section, 'fy_daily_donation')), report['filters'])
+
+            with run.stats.stage(f'section {section}', rows_in=len(data)):
+                run.rendered_sections[(section, filters)] = get_section(run, data)
+
+        sections[section] = run.rendered_sections[(section, filters)]
+
+    return sections
+
+def get_weekly_detail(run, filters):
+    data = filter_donation(run.weekly_gifts, filters)
 
-    response = get_request_re(url, params)
+    yield pa.record_batch([
+        pa.array(data['receipt_date']).cast(pa.date32()),
+        pa.array(data['amount.value']),
+        pa.array(data['Name of Donor'], pa.string()),
+        pa.array(data['Purpose/ Project Description'], pa.string()),
+        pa.array(data['constituent_id']),
+        pa.array(data['campaign_id'])
+    ], schema=WEEKLY_DETAIL_SCHEMA)
 
-    if response['type'] == 'Individual':
-        name = response['first'] + ' ' + response['last']
+def get_monthly_detail(run, filters):
+    """
+    Every gift received in the financial year, read from the local store one batch at a time
+    """
+    dataset = ds.dataset(run.path('Database/Gifts'), schema=GIFT_DATASET_SCHEMA, format='parquet',
+                         partitioning=GIFT_PARTITIONING)
+
+    condition = ds.field('receipt_financial_year') >= run.calendar.financial_year
+
+    for field, values in filters.items():
+        condition = condition & ds.field(field).isin(values)
+
+    for batch in dataset.to_batches(columns=['receipt_date', 'date', 'lookup_id', 'type', 'amount.value',
+                                             'constituent_id', 'campaign_id'], filter=condition):
+        yield pa.record_batch([
+            pc.strftime(batch['receipt_date'], '%B'),
+            batch['receipt_date'].cast(pa.date32()),
+            batch['date'].cast(pa.date32()),
+            batch['lookup_id'],
+            batch['type'].cast(pa.string()),
+            batch['amount.value'],
+            batch['constituent_id'],
+            batch['campaign_id']
+        ], schema=MONTHLY_DETAIL_SCHEMA)
+
+WEEKLY_DETAIL_SCHEMA = pa.schema([
+    ('Date of Credit', pa.date32()),
+    ('Amount', pa.float64()),
+    ('Name of Donor', pa.string()),
+    ('Purpose/ Project Description', pa.string()),
+    ('Constituent ID', pa.string()),
+    ('Campaign ID', pa.string())
+])
+
+MONTHLY_DETAIL_SCHEMA = pa.schema([
+    ('Month', pa.string()),
+    ('Date of Credit', pa.date32()),
+    ('Gift Date', pa.date32()),
+    ('Gift ID', pa.string()),
+    ('Type', pa.string()),
+    ('Amount', pa.float64()),
+    ('Constituent ID', pa.string()),
+    ('Campaign ID', pa.string())
+])
+
+# Full gift lists attached with a section, in place of listing every gift in the email
+REPORT_ATTACHMENTS = {
+    'monthly': ('Monthly Gifts', MONTHLY_DETAIL_SCHEMA, get_monthly_detail),
+    'weekly': ('Weekly Gifts', WEEKLY_DETAIL_SCHEMA, get_weekly_detail)
+}
+
+def write_csv_zip(path, schema, batches):
+    """
+    Write record batches as a CSV compressed into a zip of the same name, one batch at a time. Returns the rows written.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    rows = 0
+
+    with zipfile.ZipFile(path + '.tmp', 'w', zipfile.ZIP_DEFLATED) as archive:
+        with archive.open(os.path.basename(path).replace('.zip', '.csv'), 'w', force_zip64=True) as file:
+            writer = pv.CSVWriter(file, schema)
+
+            for batch in batches:
+                writer.write_batch(batch)
+                rows += batch.num_rows
+
+            writer.close()
+
+    os.replace(path + '.tmp', path)
+
+    return rows
+
+def export_report(run, report):
+    """
+    Files attached to a report. As with sections, a file already written for the same filters by an earlier report is
+    reused.
+    """
+    run.log.info('Exporting attachments', report=report['name'])
+
+    folder = hashlib.sha1(json.dumps(report['filters'], sort_keys=True).encode()).hexdigest()[:12]
+
+    attachments = []
+    for section, (name, schema, get_detail) in REPORT_ATTACHMENTS.items():
+        if section not in report['sections']:
+            continue
+
+        path = run.path(f'Database/Attachments/{folder}/{name}.zip')
+
+        if not os.path.exists(path):
+            with run.stats.stage('export_report') as stage:
+                stage['rows_out'] = write_csv_zip(path, schema, get_detail(run, report['filters']))
+
+        attachments.append(path)
+
+    return attachments
+
+# Donors and projects of the gifts, kept in Database/ so reports join names locally instead of calling RE
+CONSTITUENT_SCHEMA = pa.schema([
+    ('constituent_id', pa.string()),
+    ('name', pa.string()),
+    ('date_modified', pa.string())
+])
+
+CAMPAIGN_SCHEMA = pa.schema([
+    ('campaign_id', pa.string()),
+    ('name', pa.string())
+])
+
+def read_dimension(run, name, schema):
+    try:
+        return pq.read_table(run.path(f'Database/{name}.parquet'), schema=schema).to_pandas()
+
+    except FileNotFoundError:
+        return schema.empty_table().to_pandas()
+
+def write_dimension(run, name, data, schema):
+    # One row per id, so joining it onto gifts never duplicates a gift
+    data = data.drop_duplicates(schema.names[0], keep='last')
+
+    data.to_parquet(run.path(f'Database/{name}.parquet.tmp'), index=False, schema=schema)
+    os.replace(run.path(f'Database/{name}.parquet.tmp'), run.path(f'Database/{name}.parquet'))
+
+def list_request_re(run, url, keep=None):
+    """
+    Every record of a list, following next_link. keep drops records that aren't needed as each page arrives.
+    """
+    records = []
+
+    while url:
+        response = get_request_re(run, url, {})
+
+        records += [record for record in response['value'] if keep is None or keep(record)]
+
+        url = response.get('next_link')
+
+    return records
+
+def get_constituent_name(constituent):
+    if constituent['type'] == 'Individual':
+        name = constituent['first'] + ' ' + constituent['last']
     else:
-        name = response['name']
+        name = constituent['name']
 
     return name
 
-def get_project(id):
-    logging.info('Getting Project Name')
+def to_constituents(records):
+    return pd.DataFrame({
+        'constituent_id': [record['id'] for record in records],
+        'name': [get_constituent_name(record) for record in records],
+        'date_modified': [record.get('date_modified') for record in records]
+    }, columns=CONSTITUENT_SCHEMA.names, dtype=object)
+
+def get_constituents(run, ids):
+    run.log.info('Getting Constituents', ids=len(ids))
+
+    # Constituent list endpoint accepts many ids at once, chunked to keep the URL short
+    urls = [
+        f'{run.re_api_url}/constituent/v1/constituents?include_inactive=true&include_deceased=true&limit=100&' +
+        '&'.join(f'constituent_id={id}' for id in ids[start:start + 100])
+        for start in range(0, len(ids), 100)
+    ]
 
-    url = f'https://api.sky.blackbaud.com/fundraising/v1/campaigns/{id}'
-    params = {}
+    records = [record for response in get_requests_re(run, urls) for record in response['value']]
 
-    response = get_request_re(url, params)
+    # Anything the list didn't return is looked up individually
+    found = {record['id'] for record in records}
+    missing = [id for id in ids if id not in found]
 
-    return response['description']
+    records += get_requests_re(run, [f'{run.re_api_url}/constituent/v1/constituents/{id}' for id in missing])
 
-def send_email():
-    logging.info('Sending email')
+    return to_constituents(records)
 
-    subject = 'Donation Summary | Raisers Edge'
+def sync_constituents(run, ids):
+    """
+    Bring Database/Constituents.parquet up to date for the donors of the given gifts. Donors not stored yet are fetched
+    by id, the rest only when RE lists them as changed since the last sync. They are all fetched again every
+    FULL_SYNC_DAYS, as merged or deleted records don't show up as changed.
+    """
+    run.log.info('Syncing Constituents')
 
-    authority = f'https://login.microsoftonline.com/{TENANT_ID}'
+    sync_state = get_sync_state(run)
+    referenced = set(pd.unique(ids.dropna()))
 
-    app = msal.ConfidentialClientApplication(
-        client_id=O_CLIENT_ID,
-        client_credential=CLIENT_SECRET,
-        authority=authority
-    )
+    with run.stats.stage('sync constituents', rows_in=len(referenced)) as stage:
+        constituents = run.constituents if run.constituents is not None else \
+            read_dimension(run, 'Constituents', CONSTITUENT_SCHEMA)
+
+        last_full_sync = sync_state.get('constituents_full_sync')
+        full_sync = not sync_state.get('constituents_modified') or not last_full_sync or \
+            datetime.now() - datetime.fromisoformat(last_full_sync) >= timedelta(days=run.full_sync_days)
+
+        if full_sync:
+            changed = get_constituents(run, sorted(referenced))
+            constituents = changed
+            sync_state['constituents_full_sync'] = datetime.now().isoformat()
+
+        else:
+            changed = to_constituents(list_request_re(
+                run,
+                f'{run.re_api_url}/constituent/v1/constituents?include_inactive=true&include_deceased=true&limit=5000'
+                f'&last_modified={quote(sync_state["constituents_modified"])}',
+                keep=lambda record: record['id'] in referenced
+            ))
+
+            missing = referenced - set(constituents['constituent_id']) - set(changed['constituent_id'])
+            changed = pd.concat([changed, get_constituents(run, sorted(missing))], ignore_index=True)
+
+            constituents = pd.concat([
+                constituents[~constituents['constituent_id'].isin(changed['constituent_id'])], changed
+            ], ignore_index=True)
+
+        # Same high-water mark as the gifts, the latest modification seen rather than the time of the run
+        if changed['date_modified'].notna().any():
+            last_modified = pd.to_datetime(changed['date_modified'], utc=True).max().strftime('%Y-%m-%dT%H:%M:%SZ')
+            sync_state['constituents_modified'] = max(last_modified, sync_state.get('constituents_modified') or last_modified)
+
+        write_dimension(run, 'Constituents', constituents, CONSTITUENT_SCHEMA)
+        save_sync_state(run, sync_state)
 
-    scopes = ['https://graph.microsoft.com/.default']
+        stage['rows_out'] = len(changed)
 
-    result = None
-    result = app.acquire_token_silent(scopes, account=None)
+    return constituents
 
-    if not result:
-        result = app.acquire_token_for_client(scopes=scopes)
+def sync_campaigns(run, ids):
+    """
+    Replace Database/Campaigns.parquet with every campaign in RE, only a few pages however many gifts there are
+    """
+    run.log.info('Syncing Campaigns')
+
+    with run.stats.stage('sync campaigns') as stage:
+        records = list_request_re(run, f'{run.re_api_url}/fundraising/v1/campaigns?include_inactive=true&limit=500')
+
+        # Campaigns the list left out are looked up individually
+        found = {record['id'] for record in records}
+        missing = [id for id in pd.unique(ids.dropna()) if id not in found]
+
+        records += get_requests_re(run, [f'{run.re_api_url}/fundraising/v1/campaigns/{id}' for id in missing])
+
+        campaigns = pd.DataFrame({
+            'campaign_id': [record['id'] for record in records],
+            'name': [record['description'] for record in records]
+        }, columns=CAMPAIGN_SCHEMA.names, dtype=object)
+
+        write_dimension(run, 'Campaigns', campaigns, CAMPAIGN_SCHEMA)
+
+        stage['rows_out'] = len(campaigns)
 
-    start = '''
+    return campaigns
+
+# Body of the report email, each section is its heading followed by its table
+EMAIL_TEMPLATE = TEMPLATES.from_string('''
     <!DOCTYPE html>
     <html>
     <head>
@@ -704,6 +2343,8 @@ def send_email():
                                     Dear Team,<br><br>
                                     Below are the details of the Donations as recorded in Raisers Edge.
                                 </p>
+    {% for section, table in sections.items() %}
+{% if section == 'ytd' %}
                                 <p align="center" style="font-size: 32px; font-weight: 800; line-height: 24px; color: #333333; padding-top: 10px;">
                                     YTD Summary
                                 </p>
@@ -711,34 +2352,43 @@ def send_email():
                                     <b>Gifts received in current financial year</b>
                                     <br>
                                 </p>
-    '''
-
-    tr_date = '''
+    {% elif section == 'previous_ytd' %}
     <p align="center" style="font-size: 16px; font-weight: 400; line-height: 24px; color: #333333;">
         <br>
         <b>Gifts received in current financial year with gift date in previous financial years</b>
         <br>
     </p>
-    '''
-
-    month = '''
+    {% elif section == 'monthly' %}
     <p align="center" style="font-size: 32px; font-weight: 800; line-height: 24px; color: #333333; padding-top: 10px;">
                             <br>
                             Monthwise Summary
                         </p>
-    '''
-
-    weekly = '''
+    {% elif section == 'yoy_monthly' %}
+    <p align="center" style="font-size: 32px; font-weight: 800; line-height: 24px; color: #333333; padding-top: 10px;">
+                            <br>
+                            Monthwise against Last Year
+                        </p>
+    {% elif section == 'yoy_weekly' %}
+    <p align="center" style="font-size: 32px; font-weight: 800; line-height: 24px; color: #333333; padding-top: 10px;">
+                            <br>
+                            Weekwise against Last Year
+                        </p>
+    {% elif section == 'rolling' %}
+    <p align="center" style="font-size: 32px; font-weight: 800; line-height: 24px; color: #333333; padding-top: 10px;">
+                            <br>
+                            Rolling 52 Weeks
+                        </p>
+    {% elif section == 'weekly' %}
     <p align="center" style="font-size: 32px; font-weight: 800; line-height: 24px; color: #333333; padding-top: 10px;">
                             <br>
                             Weekly Summary
                         </p>
-    '''
-
-    end = '''
+    {% endif %}
+{{ table }}
+{% endfor %}
     <p align="left" style="font-size: 16px; font-weight: 200; line-height: 24px; color: #333333;">
                                 <br>
-                                The weekly summary is for a period of <b>start_date</b> to <b>end_date</b>.<br><br>
+                                The weekly summary is for a period of <b>{{ start_date }}</b> to <b>{{ end_date }}</b>.<br><br>
                             </p>
                         </td>
                     </tr>
@@ -809,44 +2459,79 @@ def send_email():
         </table>
         </body>
         </html>
-    '''
+    ''')
+
+def get_email(run, report, sections, attachments=()):
+    """
+    Message of a report, and the attachments that are too large to send in it and have to be uploaded
+    """
+    run.log.info('Preparing email', report=report['name'])
 
-    emailbody = start + ytd_report + tr_date + previous_ytd_report + month + monthly_donation + weekly + weekly_donation + end
-    emailbody = emailbody.replace('start_date', (pd.to_datetime('today') - timedelta(days=7)).strftime('%d %b, %Y')).replace('end_date', pd.to_datetime('today').strftime('%d %b, %Y'))
+    subject = report['subject']
 
-    if "access_token" in result:
-        endpoint = f'https://graph.microsoft.com/v1.0/users/{FROM}/sendMail'
-
-        email_msg = {
-            'Message': {
-                'Subject': subject,
-                'Body': {
-                    'ContentType': 'HTML',
-                    'Content': emailbody
-                },
-                'ToRecipients': get_recipients(SEND_TO),
-                'ccRecipients': get_recipients(CC_TO),
-            },
-            'SaveToSentItems': 'true'
-        }
+    emailbody = EMAIL_TEMPLATE.render(
+        sections=sections,
+        start_date=run.calendar.week_start.strftime('%d %b, %Y'),
+        end_date=run.calendar.today.strftime('%d %b, %Y')
+    )
 
-        r = requests.post(
-            endpoint,
-            headers={
-                'Authorization': 'Bearer ' + result['access_token']
+    email_msg = {
+        'Message': {
+            'Subject': subject,
+            'Body': {
+                'ContentType': 'HTML',
+                'Content': emailbody
             },
-            json=email_msg
-        )
+            'ToRecipients': get_recipients(report['send_to']),
+            'ccRecipients': get_recipients(report['cc_to']),
+        },
+        'SaveToSentItems': 'true'
+    }
 
-        if r.ok:
-            print('Sent email successfully')
-        else:
-            print(r.json())
+    if sum(os.path.getsize(path) for path in attachments) > GraphMailer.INLINE_ATTACHMENT_BYTES:
+        return email_msg, list(attachments)
+
+    email_msg['Message']['Attachments'] = [get_attachment(path) for path in attachments]
+
+    return email_msg, []
+
+def get_attachment(path):
+    with open(path, 'rb') as file:
+        content = base64.b64encode(file.read()).decode('utf-8')
+
+    return {
+        '@odata.type': '#microsoft.graph.fileAttachment',
+        'Name': os.path.basename(path),
+        'ContentType': 'application/zip',
+        'ContentBytes': content
+    }
+
+def send_email(run, emails):
+    """
+    Emails are (message, attachments to upload) pairs. Messages with everything inline are sent together in batches,
+    the rest one at a time.
+    """
+    run.log.info('Sending emails', emails=len(emails))
+
+    result = get_mailer(run).acquire_token()
+
+    if "access_token" in result:
+        with run.stats.stage('send_email', rows_in=len(emails)) as stage:
+            batched = iter(get_mailer(run).send_batch([email_msg for email_msg, uploads in emails if not uploads]))
+
+            for email_msg, uploads in emails:
+                status = get_mailer(run).send_with_uploads(email_msg, uploads) if uploads else next(batched)
+
+                if status == 202:
+                    run.log.info('Sent email successfully', subject=email_msg['Message']['Subject'])
+                    stage['rows_out'] += 1
+                else:
+                    run.log.error('Unable to send email', subject=email_msg['Message']['Subject'], status=status)
 
     else:
-        print(result.get('error'))
-        print(result.get('error_description'))
-        print(result.get('correlation_id'))
+        run.log.error('Unable to get a Graph token', error=result.get('error'),
+                      error_description=result.get('error_description'),
+                      correlation_id=result.get('correlation_id'))
 
 def get_recipients(email_list):
     value = []
@@ -862,63 +2547,113 @@ def get_recipients(email_list):
 
     return value
 
-try:
-    # Set current directory
-    set_current_directory()
-
-    # Start Logging for Debugging
-    start_logging()
-
+def start_run(run):
+    """
+    Settings, HTTP session, RE token and locale, set up once however many times the run syncs and reports
+    """
     # Retrieve contents from .env file
-    get_env_variables()
+    get_env_variables(run)
 
-    # Housekeeping
-    housekeeping()
+    # Profile the run if asked to
+    start_profiling(run)
 
     # Set API Request strategy
-    set_api_request_strategy()
+    set_api_request_strategy(run)
+
+    # Load RE access token
+    set_token_provider(run)
 
     # Set Locale
-    set_locale()
+    set_locale(run)
 
+def sync_donation(run):
+    """
+    Bring the local store, names and snapshots up to date with RE, and build the frames every report is cut from
+    """
     # Get Years
-    current_date, current_month, current_year, financial_year, start_gift_date = get_timeline()
+    run.calendar = get_timeline(run)
 
     # Get the complete Donation
-    re_donation = get_donation().copy()
-    re_donation.to_parquet('Database/RE Donations.parquet', index=False)
+    run.daily_donation = get_donation(run)
 
-    # Format the dates
-    re_donation['receipt_date'] = pd.to_datetime(re_donation['receipt_date'])
-    re_donation['date'] = pd.to_datetime(re_donation['date'])
+    # Only gifts received in the current financial year onwards are needed for the gift lists, sorted by receipt date
+    # for FiscalCalendar.window
+    run.re_donation = read_donation(run, run.calendar.financial_year, columns=[
+        'receipt_date', 'date', 'amount.value', 'constituent_id', 'campaign_id'
+    ]).sort_values('receipt_date', kind='stable', ignore_index=True)
 
-    # Get YTD Donation - based on receipt date
-    ytd_report = get_ytd_donation()
+    # Donors and projects of those gifts, so the reports need no more calls to RE
+    run.constituents = sync_constituents(run, run.re_donation['constituent_id'])
+    run.campaigns = sync_campaigns(run, run.re_donation['campaign_id'])
 
-    # Get YTD Donation - based on transaction date
-    previous_ytd_report = get_previous_year_donations()
+    # History of the weekly totals, for the year-over-year sections
+    run.weekly_snapshots = save_weekly_snapshot(run, run.daily_donation)
 
-    # Get Monthly Donation
-    monthly_donation = get_monthly_donation()
+    # Shared by every report, so that sending N reports costs about as much as sending one
+    run.fy_daily_donation = run.daily_donation[
+        run.daily_donation['receipt_financial_year'] >= run.calendar.financial_year]
+    run.weekly_gifts = get_weekly_gifts(run)
+    run.rendered_sections = {}
 
-    # Get Weekly Donation
-    weekly_donation = get_weekly_donation()
-
-    # Send Email
-    send_email()
+def send_reports(run, reports, send=True):
+    """
+    Render each report from the frames of the last sync, then send them all together. Returns the emails.
+    """
+    emails = [get_email(run, report, render_report(run, report), export_report(run, report)) for report in reports]
 
-except Exception as Argument:
+    if send:
+        send_email(run, emails)
 
-    logging.error(Argument)
+    return emails
 
-    send_error_emails('Error while getting YTD Donation from Raisers Edge', Argument)
+def run_reports(run, send=True):
+    """
+    All steps of a run, from settings to sending the reports. Returns the emails, which are built either way, send=False
+    only skips sending them.
+    """
+    # Start Logging for Debugging
+    start_logging(run)
 
-finally:
+    # Settings, HTTP session and RE token
+    start_run(run)
 
     # Housekeeping
-    housekeeping()
+    housekeeping(run)
+
+    # Reports to send, read first so a mistake in Reports.json fails the run before the sync
+    reports = load_report_definitions(run)
+
+    # Sync with RE
+    sync_donation(run)
+
+    return send_reports(run, reports, send)
+
+if __name__ == '__main__':
+    # Set current directory
+    set_current_directory()
+
+    run = ReportRun()
+
+    try:
+        run_reports(run)
+
+    except Exception as Argument:
+
+        run.log.error('Run failed', error=repr(Argument))
+
+        run.stats.error = repr(Argument)
+
+        send_error_emails(run, 'Error while getting YTD Donation from Raisers Edge', Argument)
+
+    finally:
+
+        # Housekeeping
+        housekeeping(run)
+
+        # Timings, memory and HTTP traffic of each stage
+        write_run_summary(run)
 
-    # Stop Logging
-    stop_logging()
+        # Stop Logging
+        stop_logging(run)
 
-    exit()
\ No newline at end of file
+        exit()
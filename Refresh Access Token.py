@@ -1,4 +1,4 @@
-import json, requests, os, shutil
+import json, requests, os, shutil, fcntl
 from requests.adapters import HTTPAdapter
 from urllib3 import Retry
 
@@ -37,6 +37,10 @@ def access_token():
 og_file = "access_token_output.json"
 bak_file = "access_token_output.json.bak"
 
+# Same lock as the report job's in-process refresh, so only one of them refreshes at a time
+lock_file = open("access_token_output.json.lock", "w")
+fcntl.flock(lock_file, fcntl.LOCK_EX)
+
 # Check if the output is empty
 if access_token() == "":
     shutil.copyfile(bak_file, og_file)
@@ -65,10 +69,15 @@ data = {
 # API Request
 response = http.post(url, data=data, headers=headers).json()
 
-# Write output to JSON file
-with open("access_token_output.json", "w") as response_output:
+# Write output to JSON file, replacing it atomically so readers never see a half-written file
+with open("access_token_output.json.tmp", "w") as response_output:
     json.dump(response, response_output, ensure_ascii=False, sort_keys=True, indent=4)
 
+os.replace("access_token_output.json.tmp", "access_token_output.json")
+
 # Check if the output is empty
 if access_token() == "":
-    shutil.copyfile(bak_file, og_file)
\ No newline at end of file
+    shutil.copyfile(bak_file, og_file)
+
+fcntl.flock(lock_file, fcntl.LOCK_UN)
+lock_file.close()
@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+
+"""
+Long-running Donation report service, in place of the cron jobs of 'Refresh Access Token.py' and
+'Get Donation data.py'. It keeps the RE access token fresh, syncs with Raisers Edge every SYNC_INTERVAL_MINUTES and
+keeps the aggregates, names and rendered sections of the last sync in memory, so a report goes out in seconds when
+REPORT_SCHEDULE says it is due or when it is triggered from the command line.
+
+Usage:
+    python3 'Report Service.py' serve
+    python3 'Report Service.py' trigger report
+    python3 'Report Service.py' trigger report --sync
+    python3 'Report Service.py' trigger sync
+    python3 'Report Service.py' status
+"""
+
+import os
+import sys
+import json
+import signal
+import argparse
+import threading
+import importlib.util
+import requests
+
+from datetime import datetime
+from datetime import timedelta
+from urllib.parse import urlsplit, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from dotenv import dotenv_values
+
+SCRIPTS = os.path.dirname(os.path.abspath(__file__))
+
+# How often the scheduler wakes up to check the token and whether a sync or report is due, well within the margin
+# TokenProvider refreshes ahead of expiry
+SCHEDULER_TICK = 30
+
+
+def load_script(name):
+    # Scripts have spaces in their names, so they can't be imported the usual way
+    spec = importlib.util.spec_from_file_location(name.lower().replace(' ', '_'), os.path.join(SCRIPTS, f'{name}.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    return module
+
+
+def get_service_settings(run):
+    env = run.env
+
+    run.service_port = int(env.get('SERVICE_PORT', 8765))
+    run.sync_interval = timedelta(minutes=int(env.get('SYNC_INTERVAL_MINUTES', 60)))
+
+    # Weekday and time of the scheduled report, e.g. 'Mon 10:31', none when left empty
+    run.report_schedule = env.get('REPORT_SCHEDULE', 'Mon 10:31').strip()
+
+
+REPORT_WEEKDAYS = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
+
+
+def next_report_time(schedule, after):
+    if not schedule:
+        return None
+
+    # strptime has no year to put a weekday in, so the day is looked up on its own
+    day, hour_minute = schedule.split()
+    scheduled = datetime.strptime(hour_minute, '%H:%M')
+
+    due = after.replace(hour=scheduled.hour, minute=scheduled.minute, second=0, microsecond=0) + timedelta(
+        days=(REPORT_WEEKDAYS.index(day.title()[:3]) - after.weekday()) % 7)
+
+    return due if due > after else due + timedelta(days=7)
+
+
+class ReportService:
+    """
+    One warm ReportRun shared by the scheduler and the local HTTP trigger. Syncs and reports take turns on a lock,
+    as every sync replaces the frames the reports are cut from.
+    """
+
+    def __init__(self, report, directory='.'):
+        self.report = report
+        self.run = report.ReportRun(directory)
+
+        # Logs/Report_Service.log and its summary, apart from those of the cron job
+        self.run.process_name = 'Report_Service'
+
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+
+        self.last_sync = None
+        self.next_sync = None
+        self.last_report = None
+        self.next_report = None
+        self.last_error = None
+
+    def start(self):
+        self.report.start_logging(self.run)
+        self.report.start_run(self.run)
+        get_service_settings(self.run)
+
+        # Sync straight away, so the first report is already served warm
+        self.next_sync = datetime.now()
+        self.next_report = next_report_time(self.run.report_schedule, datetime.now())
+
+        self.run.log.info('Starting the Report service', port=self.run.service_port,
+                          sync_interval=self.run.sync_interval, next_report=self.next_report)
+
+    def stop(self):
+        self.report.stop_logging(self.run)
+
+    def step(self, name, function):
+        """
+        Run one sync or report with stats of its own. A failure is logged and emailed as for a cron run, and the
+        service carries on with the state of the last good sync.
+        """
+        self.run.stats = self.report.RunStats(self.run.stats.memory_limit_mb)
+
+        try:
+            result = function()
+            self.last_error = None
+
+            return result
+
+        except Exception as Argument:
+            self.run.log.error(f'Report service {name} failed', error=repr(Argument))
+
+            self.run.stats.error = self.last_error = repr(Argument)
+
+            self.report.send_error_emails(self.run, 'Error while getting YTD Donation from Raisers Edge', Argument)
+
+        finally:
+            # Timings, memory and HTTP traffic of the step
+            self.report.write_run_summary(self.run)
+            self.run.log.write_counts()
+
+    def sync(self):
+        with self.lock:
+            self.step('sync', self.sync_locked)
+
+        return self.status()
+
+    def sync_locked(self):
+        # Temporary files and attachments of the last sync go before the new one replaces its frames
+        self.report.housekeeping(self.run)
+
+        try:
+            self.report.sync_donation(self.run)
+
+        except Exception:
+            # Database/ may have got ahead of the frames in memory before the sync failed, so the next one reads the
+            # aggregate and names back from it
+            self.run.daily_donation = None
+            self.run.constituents = None
+            raise
+
+        self.last_sync = datetime.now()
+        self.next_sync = self.last_sync + self.run.sync_interval
+
+    def send(self, sync=False):
+        with self.lock:
+            if sync or self.last_sync is None:
+                self.step('sync', self.sync_locked)
+
+            # Nothing to report from until a sync has gone through
+            if self.last_sync is None:
+                return {**self.status(), 'emails': 0}
+
+            # Reports.json is read every time, so changes to it don't need a restart
+            emails = self.step('report', lambda: self.report.send_reports(
+                self.run, self.report.load_report_definitions(self.run)))
+
+            if emails is not None:
+                self.last_report = datetime.now()
+
+        return {**self.status(), 'emails': len(emails or [])}
+
+    def status(self):
+        return {
+            'last_sync': self.last_sync,
+            'next_sync': self.next_sync,
+            'last_report': self.last_report,
+            'next_report': self.next_report,
+            'error': self.last_error
+        }
+
+    def serve_forever(self):
+        while not self.stopping.is_set():
+            now = datetime.now()
+
+            # Refreshes the token once it gets close to expiry, as the cron job of 'Refresh Access Token.py' did
+            try:
+                self.run.token_provider.get()
+
+            except Exception as Argument:
+                self.run.log.error('Unable to refresh RE access token', error=repr(Argument))
+
+            if self.next_report is not None and now >= self.next_report:
+                self.next_report = next_report_time(self.run.report_schedule, now)
+                self.send(sync=True)
+
+            elif now >= self.next_sync:
+                self.sync()
+
+            self.stopping.wait(SCHEDULER_TICK)
+
+
+class TriggerHandler(BaseHTTPRequestHandler):
+    """
+    Local trigger of the service: GET /status, POST /sync and POST /report (?sync=true to sync first). Requests are
+    answered once the step is done.
+    """
+
+    service = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if urlsplit(self.path).path == '/status':
+            return self.send_json(200, self.service.status())
+
+        self.send_json(404, {'error': 'Not found'})
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+
+        self.service.run.log.info('Report service triggered', path=self.path)
+
+        if url.path == '/sync':
+            return self.send_json(200, self.service.sync())
+
+        if url.path == '/report':
+            return self.send_json(200, self.service.send(sync=query.get('sync', ['false'])[0].lower() == 'true'))
+
+        self.send_json(404, {'error': 'Not found'})
+
+    def send_json(self, status, body):
+        content = json.dumps(body, default=str).encode('utf-8')
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+def serve(report):
+    service = ReportService(report)
+    service.start()
+
+    TriggerHandler.service = service
+
+    # Only reachable from the machine itself, the trigger has no authentication
+    server = ThreadingHTTPServer(('127.0.0.1', service.run.service_port), TriggerHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: service.stopping.set())
+
+    try:
+        service.serve_forever()
+
+    except KeyboardInterrupt:
+        pass
+
+    finally:
+        server.shutdown()
+        service.run.log.info('Stopping the Report service')
+        service.stop()
+
+
+def trigger(method, path):
+    port = int({**dotenv_values('.env'), **os.environ}.get('SERVICE_PORT', 8765))
+
+    # A sync can take minutes, and the service answers once it is done
+    try:
+        response = requests.request(method, f'http://127.0.0.1:{port}{path}', timeout=None)
+
+    except requests.ConnectionError:
+        sys.exit(f"No Report service on port {port}, start it with: python3 'Report Service.py' serve")
+
+    print(json.dumps(response.json(), indent=4))
+
+    if response.status_code != 200 or response.json().get('error'):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['serve', 'trigger', 'status'])
+    parser.add_argument('step', nargs='?', choices=['report', 'sync'], default='report')
+    parser.add_argument('--sync', action='store_true', help='sync with RE before sending the report')
+    args = parser.parse_args()
+
+    # Database/, Logs/, .env and the access token are all read from the current directory, as with the cron jobs
+    os.chdir(os.getcwd())
+
+    if args.command == 'serve':
+        serve(load_script('Get Donation data'))
+
+    elif args.command == 'status':
+        trigger('GET', '/status')
+
+    elif args.step == 'sync':
+        trigger('POST', '/sync')
+
+    else:
+        trigger('POST', '/report?sync=true' if args.sync else '/report')
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+
+"""
+Local stand-in for the Microsoft Graph endpoints the Donation report sends its emails through: sendMail, JSON $batch,
+and draft messages with attachments uploaded through an upload session. Point the report at it with GRAPH_URL in .env,
+and give the run a TokenStub as its graph_app so no token is asked of login.microsoftonline.com.
+
+Usage:
+    python3 'Simulate Graph API.py' --port 8001 --throttle 0.1
+"""
+
+import re
+import sys
+import json
+import base64
+import random
+import argparse
+import itertools
+import threading
+
+from urllib.parse import urlsplit, quote, unquote
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+TOKEN = 'simulator'
+
+
+class TokenStub:
+    """
+    Takes the place of the msal app of GraphMailer, handing out the token the simulator accepts
+    """
+
+    def acquire_token_for_client(self, scopes):
+        return {'access_token': TOKEN, 'token_type': 'Bearer', 'expires_in': 3600}
+
+
+class Simulator(BaseHTTPRequestHandler):
+    """
+    Answers like Graph does for mail: messages are accepted with a 202, a share of those in a $batch is throttled with a
+    429 and Retry-After, files under 3 MB are attached to a draft in one request and larger ones through an upload
+    session in Content-Range chunks. GET /sent lists what was sent, with the size of each attachment.
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    # Set by serve()
+    throttle = 0
+    retry_after = 1
+
+    # Graph only opens upload sessions for files of 3 MB or more, smaller ones have to be attached in one request
+    UPLOAD_SESSION_BYTES = 3 * 1024 * 1024
+
+    # Messages sent, drafts and their attachments as uploaded so far, shared by every request
+    sent = []
+    drafts = {}
+    draft_ids = itertools.count(1)
+    lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if urlsplit(self.path).path == '/sent':
+            with self.lock:
+                return self.send_json(200, {'value': self.sent})
+
+        self.send_json(404, {'error': {'code': 'ResourceNotFound'}})
+
+    def do_POST(self):
+        path = unquote(urlsplit(self.path).path)
+        body = self.read_json()
+
+        if self.headers.get('Authorization') != f'Bearer {TOKEN}':
+            return self.send_json(401, {'error': {'code': 'InvalidAuthenticationToken'}})
+
+        if path == '/$batch':
+            return self.send_json(200, {'responses': [self.batch_item(item) for item in body['requests']]})
+
+        if re.fullmatch(r'/users/[^/]+/sendMail', path):
+            self.record(body['Message'])
+            return self.send_json(202, None)
+
+        if re.fullmatch(r'/users/[^/]+/messages', path):
+            with self.lock:
+                message_id = f'draft-{next(self.draft_ids)}'
+                self.drafts[message_id] = {'message': body, 'attachments': {}}
+
+            return self.send_json(201, {'id': message_id})
+
+        match = re.fullmatch(r'/users/[^/]+/messages/([^/]+)/attachments', path)
+        if match and match.group(1) in self.drafts:
+            size = len(base64.b64decode(body['ContentBytes']))
+
+            if size >= self.UPLOAD_SESSION_BYTES:
+                return self.send_json(413, {'error': {'code': 'ErrorRequestEntityTooLarge'}})
+
+            with self.lock:
+                self.drafts[match.group(1)]['attachments'][body['Name']] = {'size': size, 'received': size}
+
+            return self.send_json(201, {'id': body['Name']})
+
+        match = re.fullmatch(r'/users/[^/]+/messages/([^/]+)/attachments/createUploadSession', path)
+        if match and match.group(1) in self.drafts:
+            item = body['AttachmentItem']
+
+            if item['size'] < self.UPLOAD_SESSION_BYTES:
+                return self.send_json(400, {'error': {'code': 'ErrorAttachmentSizeShouldNotBeLessThanMinimumSize'}})
+
+            with self.lock:
+                self.drafts[match.group(1)]['attachments'][item['name']] = {'size': item['size'], 'received': 0}
+
+            return self.send_json(200, {
+                'uploadUrl': f'http://{self.headers["Host"]}/upload/{quote(match.group(1))}/{quote(item["name"])}',
+                'nextExpectedRanges': ['0-']
+            })
+
+        match = re.fullmatch(r'/users/[^/]+/messages/([^/]+)/send', path)
+        if match and match.group(1) in self.drafts:
+            with self.lock:
+                draft = self.drafts.pop(match.group(1))
+
+            # A draft is only sent once every attachment is uploaded in full
+            if any(upload['received'] != upload['size'] for upload in draft['attachments'].values()):
+                return self.send_json(400, {'error': {'code': 'ErrorAttachmentIncomplete'}})
+
+            self.record(draft['message'], {name: upload['size'] for name, upload in draft['attachments'].items()})
+            return self.send_json(202, None)
+
+        self.send_json(404, {'error': {'code': 'ResourceNotFound'}})
+
+    def do_PUT(self):
+        # Upload URLs are pre-authenticated, so no token is checked
+        match = re.fullmatch(r'/upload/([^/]+)/(.+)', unquote(urlsplit(self.path).path))
+        chunk = self.rfile.read(int(self.headers['Content-Length']))
+
+        if not match or match.group(1) not in self.drafts:
+            return self.send_json(404, {'error': {'code': 'ResourceNotFound'}})
+
+        first, last, size = map(int, re.fullmatch(r'bytes (\d+)-(\d+)/(\d+)', self.headers['Content-Range']).groups())
+
+        with self.lock:
+            upload = self.drafts[match.group(1)]['attachments'][match.group(2)]
+
+            # Chunks have to come in order, each the length its range says
+            if first != upload['received'] or last - first + 1 != len(chunk) or size != upload['size']:
+                return self.send_json(416, {'error': {'code': 'InvalidRange'}})
+
+            upload['received'] = last + 1
+
+        if upload['received'] == size:
+            return self.send_json(201, {})
+
+        self.send_json(200, {'nextExpectedRanges': [f'{upload["received"]}-']})
+
+    def batch_item(self, item):
+        if random.random() < self.throttle:
+            return {'id': item['id'], 'status': 429, 'headers': {'Retry-After': str(self.retry_after)}}
+
+        self.record(item['body']['Message'])
+
+        return {'id': item['id'], 'status': 202, 'headers': {}}
+
+    def record(self, message, attachments=None):
+        with self.lock:
+            self.sent.append({
+                'subject': message['Subject'],
+                'to': [recipient['emailAddress']['address'] for recipient in message.get('ToRecipients', [])],
+                'attachments': attachments or {
+                    attachment['Name']: len(base64.b64decode(attachment['ContentBytes']))
+                    for attachment in message.get('Attachments', [])
+                }
+            })
+
+    def read_json(self):
+        content = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+        return json.loads(content) if content else None
+
+    def send_json(self, status, body):
+        content = b'' if body is None else json.dumps(body).encode('utf-8')
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+def serve(port=8001, throttle=0, retry_after=1):
+    Simulator.throttle = throttle
+    Simulator.retry_after = retry_after
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), Simulator)
+    server.daemon_threads = True
+
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--throttle', type=float, default=0, help='share of messages in a $batch answered with a 429')
+    parser.add_argument('--retry-after', type=int, default=1, help='Retry-After of throttled messages, in seconds')
+    args = parser.parse_args()
+
+    server = serve(args.port, args.throttle, args.retry_after)
+
+    print(f'Serving Graph mail on http://127.0.0.1:{args.port}, set GRAPH_URL to it in .env', file=sys.stderr, flush=True)
+
+    server.serve_forever()
@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+
+"""
+Local stand-in for the Raiser's Edge SKY API endpoints the Donation report uses, serving synthetic gifts, donors and
+campaigns. Point the report at it with RE_API_URL in .env.
+
+Usage:
+    python3 'Simulate RE API.py' --gifts 100000 --page-size 500 --latency 0.05 --throttle 0.01
+"""
+
+import re
+import sys
+import json
+import time
+import random
+import argparse
+import functools
+
+from datetime import datetime
+from datetime import timedelta
+from urllib.parse import urlsplit, parse_qs, urlencode
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Gifts are spread over the three years before the simulator started, so every report section has data
+TODAY = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+
+# Gifts are split between this many campaigns
+CAMPAIGNS = 200
+
+
+def synthetic_gift(i):
+    # Same shape as a gift from /gift/v1/gifts
+    rng = random.Random(i)
+
+    gift_date = (TODAY - timedelta(days=rng.randint(0, 3 * 365))).strftime('%Y-%m-%d')
+    gift_type = rng.choice(['Donation', 'MatchingGiftPayment', 'PledgePayment', 'RecurringGiftPayment', 'GiftInKind'])
+
+    return {
+        'id': str(i + 1),
+        'amount': {'value': round(rng.uniform(100, 500000), 2)},
+        'constituent_id': str(rng.randint(1, max(i // 4, 1))),
+        'date': f'{gift_date}T00:00:00',
+        'date_added': f'{gift_date}T10:15:30.1234567+05:30',
+        'date_modified': f'{gift_date}T10:15:30.1234567+05:30',
+        'gift_status': 'Active',
+        'is_anonymous': False,
+        'lookup_id': str(100000 + i),
+        'post_status': 'Posted',
+        'type': gift_type,
+        'receipts': [] if rng.random() < 0.1 else [
+            {'amount': {'value': 0}, 'date': f'{gift_date}T00:00:00', 'status': 'Receipted'}
+        ],
+        'gift_splits': [
+            {
+                'id': str(i + 1),
+                'amount': {'value': 0},
+                'appeal_id': str(rng.randint(1, 50)),
+                'campaign_id': str(rng.randint(1, CAMPAIGNS)),
+                'fund_id': str(rng.randint(1, 500))
+            }
+        ]
+    }
+
+
+def synthetic_constituent(id):
+    rng = random.Random(f'constituent-{id}')
+
+    date_modified = (TODAY - timedelta(days=rng.randint(0, 3 * 365))).strftime('%Y-%m-%dT10:15:30.1234567+05:30')
+
+    if rng.random() < 0.8:
+        return {
+            'id': id,
+            'type': 'Individual',
+            'first': rng.choice(['Asha', 'Rahul', 'Meera', 'Vikram', 'Priya', 'Arjun']),
+            'last': rng.choice(['Shah', 'Iyer', 'Patel', 'Khan', 'Das', 'Rao']),
+            'date_modified': date_modified
+        }
+
+    return {
+        'id': id,
+        'type': 'Organization',
+        'name': f'Organization {id} & Co.',
+        'date_modified': date_modified
+    }
+
+
+def synthetic_campaign(id):
+    return {
+        'id': id,
+        'description': f'Campaign {id}'
+    }
+
+
+class Simulator(BaseHTTPRequestHandler):
+    """
+    Answers GETs like the SKY API: lists are paged by limit and offset with a next_link, and a share of requests is
+    throttled with a 429 and Retry-After the way SKY does when the quota runs out
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    # Set by serve()
+    gifts = 100000
+    page_size = 500
+    latency = 0
+    throttle = 0
+    retry_after = 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        time.sleep(self.latency)
+
+        if random.random() < self.throttle:
+            return self.send_json(429, {'statusCode': 429, 'message': 'Rate limit is exceeded.'},
+                                  {'Retry-After': str(self.retry_after)})
+
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+
+        if url.path == '/gift/v1/gifts':
+            ids = matching_gifts(self.gifts, query.get('start_gift_date', [None])[0], query.get('last_modified', [None])[0])
+            return self.send_json(200, self.list_page(url.path, query, ids, synthetic_gift))
+
+        if url.path == '/constituent/v1/constituents' and 'constituent_id' in query:
+            return self.send_json(200, {
+                'count': len(query['constituent_id']),
+                'value': [synthetic_constituent(id) for id in query['constituent_id']]
+            })
+
+        if url.path == '/constituent/v1/constituents':
+            ids = matching_constituents(self.gifts, query.get('last_modified', [None])[0])
+            return self.send_json(200, self.list_page(url.path, query, ids, synthetic_constituent))
+
+        if url.path == '/fundraising/v1/campaigns':
+            ids = [str(id) for id in range(1, CAMPAIGNS + 1)]
+            return self.send_json(200, self.list_page(url.path, query, ids, synthetic_campaign))
+
+        match = re.fullmatch(r'/constituent/v1/constituents/([^/]+)', url.path)
+        if match:
+            return self.send_json(200, synthetic_constituent(match.group(1)))
+
+        match = re.fullmatch(r'/fundraising/v1/campaigns/([^/]+)', url.path)
+        if match:
+            return self.send_json(200, synthetic_campaign(match.group(1)))
+
+        self.send_json(404, {'statusCode': 404, 'message': 'Resource not found'})
+
+    def list_page(self, path, query, ids, synthetic_record):
+        limit = int(query.get('limit', [self.page_size])[0])
+        offset = int(query.get('offset', [0])[0])
+
+        response = {
+            'count': len(ids),
+            'value': [synthetic_record(id) for id in ids[offset:offset + limit]]
+        }
+
+        if offset + limit < len(ids):
+            query.update(limit=[limit], offset=[offset + limit])
+            response['next_link'] = f'http://{self.headers["Host"]}{path}?{urlencode(query, doseq=True)}'
+
+        return response
+
+    def send_json(self, status, body, headers=None):
+        content = json.dumps(body).encode('utf-8')
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(content)))
+
+        for header, value in (headers or {}).items():
+            self.send_header(header, value)
+
+        self.end_headers()
+        self.wfile.write(content)
+
+
+@functools.lru_cache(maxsize=8)
+def matching_gifts(gifts, start_gift_date=None, last_modified=None):
+    """
+    Indexes of the gifts a list request with these filters returns, unfiltered lists don't need generating any gift
+    """
+    if start_gift_date is None and last_modified is None:
+        return range(gifts)
+
+    ids = []
+    for i in range(gifts):
+        gift = synthetic_gift(i)
+
+        if start_gift_date is not None and gift['date'][:10] < start_gift_date[:10]:
+            continue
+
+        if last_modified is not None and gift['date_modified'][:10] < last_modified[:10]:
+            continue
+
+        ids.append(i)
+
+    return ids
+
+
+@functools.lru_cache(maxsize=8)
+def matching_constituents(gifts, last_modified=None):
+    """
+    Ids of the constituents a list request returns, the donors of the gifts and as many again that never gave
+    """
+    ids = [str(id) for id in range(1, max(gifts // 2, 1) + 1)]
+
+    if last_modified is None:
+        return ids
+
+    return [id for id in ids if synthetic_constituent(id)['date_modified'][:10] >= last_modified[:10]]
+
+
+def serve(port=8000, gifts=100000, page_size=500, latency=0, throttle=0, retry_after=1):
+    Simulator.gifts = gifts
+    Simulator.page_size = page_size
+    Simulator.latency = latency
+    Simulator.throttle = throttle
+    Simulator.retry_after = retry_after
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), Simulator)
+    server.daemon_threads = True
+
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--gifts', type=int, default=100000, help='number of gifts in the list')
+    parser.add_argument('--page-size', type=int, default=500, help='gifts per page when no limit is asked for')
+    parser.add_argument('--latency', type=float, default=0, help='seconds added to every response')
+    parser.add_argument('--throttle', type=float, default=0, help='share of requests answered with a 429')
+    parser.add_argument('--retry-after', type=int, default=1, help='Retry-After of throttled requests, in seconds')
+    args = parser.parse_args()
+
+    server = serve(args.port, args.gifts, args.page_size, args.latency, args.throttle, args.retry_after)
+
+    print(f'Serving {args.gifts:,} gifts on http://127.0.0.1:{args.port}, set RE_API_URL to it in .env',
+          file=sys.stderr, flush=True)
+
+    server.serve_forever()